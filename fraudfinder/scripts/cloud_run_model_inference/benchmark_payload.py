@@ -0,0 +1,84 @@
+# Copyright 2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the per-request cost of the dict based payload assembly with the
+# schema-compiled PayloadBuilder, on DataFrames shaped like `EntityType.read` output.
+# Run locally with: python benchmark_payload.py [iterations]
+
+import sys
+import timeit
+import numpy as np
+import pandas as pd
+
+from config import PAYLOAD_SCHEMA
+from utils import PayloadBuilder
+
+def entity_read_df(entity, entity_id):
+    '''
+    Function that fakes the DataFrame returned by `EntityType.read` for one entity
+    '''
+    row = {"entity_id": entity_id}
+    for i, name in enumerate(n for n in PAYLOAD_SCHEMA if n.startswith(f"{entity}_id_")):
+        row[name] = None if i % 5 == 0 else float(i)
+    return pd.DataFrame([row])
+
+
+def preprocess(payload):
+    for key , value in payload.items():
+        if value is None:
+            payload[key] = 0.0
+    return payload
+
+
+def legacy_payload(tx_amount, customer_df, terminal_df):
+    customer_features = preprocess(customer_df).iloc[0].to_dict()
+    terminal_features = preprocess(terminal_df).iloc[0].to_dict()
+    payload = {"tx_amount": tx_amount}
+    for name in PAYLOAD_SCHEMA:
+        if name.startswith("customer_id_"):
+            payload[name] = customer_features[name]
+        elif name.startswith("terminal_id_"):
+            payload[name] = terminal_features[name]
+    return preprocess(payload)
+
+
+def compiled_payload(builder, tx_amount, customer_df, terminal_df, out):
+    customer_features = builder.entity_matrix("customer", customer_df)[0]
+    terminal_features = builder.entity_matrix("terminal", terminal_df)[0]
+    return builder.build(tx_amount, {"customer": customer_features, "terminal": terminal_features}, out)
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    builder = PayloadBuilder(PAYLOAD_SCHEMA)
+    customer_df = entity_read_df("customer", "1234")
+    terminal_df = entity_read_df("terminal", "5678")
+    out = np.empty(len(PAYLOAD_SCHEMA), dtype=np.float32)
+
+    legacy = legacy_payload(42.0, customer_df, terminal_df)
+    compiled = builder.to_instance(compiled_payload(builder, 42.0, customer_df, terminal_df, out))
+    assert list(legacy) == list(compiled)
+    assert np.allclose([float(v) for v in legacy.values()], list(compiled.values()), equal_nan=True)
+
+    customer_cached = builder.entity_matrix("customer", customer_df)[0]
+    terminal_cached = builder.entity_matrix("terminal", terminal_df)[0]
+    benchmarks = {
+        "legacy dict payload": lambda: legacy_payload(42.0, customer_df, terminal_df),
+        "compiled row payload": lambda: compiled_payload(builder, 42.0, customer_df, terminal_df, out),
+        "compiled row, cached features": lambda: builder.build(
+            42.0, {"customer": customer_cached, "terminal": terminal_cached}, out),
+    }
+    for name, fn in benchmarks.items():
+        seconds = timeit.timeit(fn, number=iterations)
+        print(f"{name:32s} {seconds / iterations * 1e6:10.1f} us/request")
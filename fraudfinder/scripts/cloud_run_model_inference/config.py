@@ -0,0 +1,131 @@
+# Copyright 2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+# Retrieve environment variables
+PROJECT_ID = os.environ.get('PROJECT_ID')
+ENDPOINT_ID = os.environ.get('ENDPOINT_ID')
+FEATURESTORE_ID = os.environ.get('FEATURESTORE_ID')
+REGION = os.environ.get('REGION')
+
+# Scoring mode: "endpoint" calls the Vertex AI endpoint, "local" scores in-process
+# with the model.bst artifact found at MODEL_PATH (local path or gs:// URI).
+SCORING_MODE = os.environ.get('SCORING_MODE', 'endpoint')
+MODEL_PATH = os.environ.get('MODEL_PATH', 'model.bst')
+# Column order the model was trained on, comma separated. Defaults to the PAYLOAD_SCHEMA order.
+MODEL_FEATURE_COLUMNS = os.environ.get('MODEL_FEATURE_COLUMNS')
+# preprocessor.json saved next to model.bst by the training app (local path or gs:// URI).
+# When set, its feature_columns give the column order instead of MODEL_FEATURE_COLUMNS.
+PREPROCESSOR_PATH = os.environ.get('PREPROCESSOR_PATH')
+
+# Feature cache settings. The streaming pipeline refreshes the 15min/30min/60min
+# window aggregates continuously, so the default TTL keeps cached values within
+# one minute of the shortest (15min) window.
+FEATURE_CACHE_ENABLED = os.environ.get('FEATURE_CACHE_ENABLED', 'true').lower() == 'true'
+FEATURE_CACHE_MAX_SIZE = int(os.environ.get('FEATURE_CACHE_MAX_SIZE', 100000))
+FEATURE_CACHE_CUSTOMER_TTL = float(os.environ.get('FEATURE_CACHE_CUSTOMER_TTL', 60))
+FEATURE_CACHE_TERMINAL_TTL = float(os.environ.get('FEATURE_CACHE_TERMINAL_TTL', 60))
+
+# Feature lookup settings. The pool is shared by all gunicorn threads, two lookups per request.
+FEATURE_LOOKUP_WORKERS = int(os.environ.get('FEATURE_LOOKUP_WORKERS', 16))
+FEATURE_LOOKUP_TIMEOUT = float(os.environ.get('FEATURE_LOOKUP_TIMEOUT', 2.0))
+
+# Feature lookup coalescing settings. Ids requested within the window are read in one call
+# per entity type. A max batch size of 1 disables coalescing.
+FEATURE_LOOKUP_MAX_BATCH = int(os.environ.get('FEATURE_LOOKUP_MAX_BATCH', 100))
+FEATURE_LOOKUP_WINDOW_MS = float(os.environ.get('FEATURE_LOOKUP_WINDOW_MS', 2))
+
+# Prediction micro-batching settings. A max batch size of 1 disables batching.
+PREDICT_BATCH_MAX_SIZE = int(os.environ.get('PREDICT_BATCH_MAX_SIZE', 8))
+PREDICT_BATCH_MAX_WAIT_MS = float(os.environ.get('PREDICT_BATCH_MAX_WAIT_MS', 5))
+PREDICT_MAX_CONCURRENT_BATCHES = int(os.environ.get('PREDICT_MAX_CONCURRENT_BATCHES', 2))
+PREDICT_TIMEOUT = float(os.environ.get('PREDICT_TIMEOUT', 10.0))
+
+# Warm-up settings. Requests wait up to WARMUP_TIMEOUT for the clients to be ready.
+# WARMUP_PREDICT sends a synthetic all-zero transaction to the model on every cold start,
+# so it is off by default to keep such predictions away from a production endpoint.
+WARMUP_PREDICT = os.environ.get('WARMUP_PREDICT', 'false').lower() == 'true'
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', 60.0))
+# A failed warm-up is retried WARMUP_ATTEMPTS times, waiting WARMUP_BACKOFF seconds and doubling
+# the wait after every failure. If the last attempt fails, the worker exits with gunicorn's
+# boot error code, which stops the gunicorn master too, so that Cloud Run replaces the instance.
+WARMUP_ATTEMPTS = int(os.environ.get('WARMUP_ATTEMPTS', 5))
+WARMUP_BACKOFF = float(os.environ.get('WARMUP_BACKOFF', 1.0))
+
+# Share of the requests logged as structured JSON lines with their payload, result and stage timings
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+
+# Async (ASGI) service settings. At most ASYNC_MAX_IN_FLIGHT transactions are processed
+# at once, the others wait up to ASYNC_QUEUE_TIMEOUT for a slot before being rejected.
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('ASYNC_MAX_IN_FLIGHT', 256))
+ASYNC_QUEUE_TIMEOUT = float(os.environ.get('ASYNC_QUEUE_TIMEOUT', 1.0))
+
+# Streaming (pull subscription) scorer settings. SUBSCRIPTION_PATH is the transactions
+# subscription, as in VertexConfig.SUBSCRIPTION_PATH.
+SUBSCRIPTION_PATH = os.environ.get('SUBSCRIPTION_PATH')
+STREAM_MAX_MESSAGES = int(os.environ.get('STREAM_MAX_MESSAGES', 100))
+STREAM_MAX_CONCURRENT_BATCHES = int(os.environ.get('STREAM_MAX_CONCURRENT_BATCHES', 2))
+STREAM_PULL_TIMEOUT = float(os.environ.get('STREAM_PULL_TIMEOUT', 30.0))
+# Topic (projects/<project>/topics/<topic>) receiving the messages that can never be scored.
+# When unset they are only logged before being acked.
+STREAM_DEAD_LETTER_TOPIC = os.environ.get('STREAM_DEAD_LETTER_TOPIC')
+
+PAYLOAD_SCHEMA = {
+    "tx_amount": "float64",
+    "customer_id_nb_tx_1day_window": "int64",
+    "customer_id_nb_tx_7day_window": "int64",
+    "customer_id_nb_tx_14day_window": "int64",
+    "customer_id_avg_amount_1day_window": "float64",
+    "customer_id_avg_amount_7day_window": "float64",
+    "customer_id_avg_amount_14day_window": "float64",
+    "customer_id_nb_tx_15min_window": "int64",
+    "customer_id_avg_amount_15min_window": "float64", 
+    "customer_id_nb_tx_30min_window": "int64",
+    "customer_id_avg_amount_30min_window": "float64", 
+    "customer_id_nb_tx_60min_window": "int64",
+    "customer_id_avg_amount_60min_window":"float64", 
+    "terminal_id_nb_tx_1day_window": "int64",
+    "terminal_id_nb_tx_7day_window": "int64",
+    "terminal_id_nb_tx_14day_window": "int64",
+    "terminal_id_risk_1day_window": "float64",
+    "terminal_id_risk_7day_window": "float64",
+    "terminal_id_risk_14day_window": "float64",
+    "terminal_id_nb_tx_15min_window": "int64",
+    "terminal_id_avg_amount_15min_window": "float64", 
+    "terminal_id_nb_tx_30min_window": "int64",
+    "terminal_id_avg_amount_30min_window":"float64", 
+    "terminal_id_nb_tx_60min_window": "int64",
+    "terminal_id_avg_amount_60min_window": "float64"
+}
+
+
+
+def validate_config():
+    '''
+    Function that checks the configuration up front, so that a misconfigured
+    revision fails at startup instead of on the first request
+    '''
+    required = {"PROJECT_ID": PROJECT_ID, "FEATURESTORE_ID": FEATURESTORE_ID, "REGION": REGION}
+    if SCORING_MODE == "endpoint":
+        required["ENDPOINT_ID"] = ENDPOINT_ID
+    missing = [name for name, value in required.items() if not value]
+    if missing:
+        raise ValueError(f"{', '.join(missing)} variable(s) must be set.")
+    if SCORING_MODE not in ("endpoint", "local"):
+        raise ValueError(f"Invalid SCORING_MODE {SCORING_MODE}.")
+    if WARMUP_ATTEMPTS < 1:
+        raise ValueError("WARMUP_ATTEMPTS must be at least 1.")
+    if SCORING_MODE == "local" and not MODEL_PATH.startswith("gs://") and not os.path.exists(MODEL_PATH):
+        raise ValueError(f"MODEL_PATH {MODEL_PATH} does not exist.")
@@ -12,152 +12,333 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
 import os
-import json
-from flask import Flask, request
-from google.cloud import aiplatform as aiplatform
-from google.cloud import pubsub_v1
-from google.cloud.aiplatform import Featurestore, EntityType, Feature
-
-# Retrieve environment variables
-PROJECT_ID = os.environ.get('PROJECT_ID', 
-                            'PROJECT_ID variable is not set.')
-ENDPOINT_ID = os.environ.get('ENDPOINT_ID', 
-                             'ENDPOINT_ID variable is not set.')
-FEATURESTORE_ID = os.environ.get('FEATURESTORE_ID', 
-                                 'FEATURESTORE_ID variable is not set.')
-REGION = os.environ.get('REGION', 
-                        'REGION variable is not set.')
+import time
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from flask import Flask, Response, request
+
+try:
+    from google.api_core.exceptions import GoogleAPIError
+except ImportError:  # local runs without the client library
+    GoogleAPIError = ConnectionError
+from config import (
+    PROJECT_ID, ENDPOINT_ID, FEATURESTORE_ID, REGION, SCORING_MODE, MODEL_PATH,
+    MODEL_FEATURE_COLUMNS, PREPROCESSOR_PATH, FEATURE_CACHE_ENABLED, FEATURE_CACHE_MAX_SIZE,
+    FEATURE_CACHE_CUSTOMER_TTL, FEATURE_CACHE_TERMINAL_TTL, FEATURE_LOOKUP_WORKERS,
+    FEATURE_LOOKUP_TIMEOUT, FEATURE_LOOKUP_MAX_BATCH, FEATURE_LOOKUP_WINDOW_MS,
+    PREDICT_BATCH_MAX_SIZE, PREDICT_BATCH_MAX_WAIT_MS, PREDICT_MAX_CONCURRENT_BATCHES,
+    PREDICT_TIMEOUT, WARMUP_PREDICT, WARMUP_TIMEOUT, WARMUP_ATTEMPTS, WARMUP_BACKOFF, LOG_SAMPLE_RATE, PAYLOAD_SCHEMA,
+    validate_config,
+)
+from utils import (
+    FeatureCache, MicroBatcher, PayloadBuilder, LocalModel, LatencyMetrics, download_model,
+    model_feature_names, log_sampled, parse_pubsub_envelope,
+)
+
+validate_config()
 
 
 app = Flask(__name__)
 
-PAYLOAD_SCHEMA = {
-    "tx_amount": "float64",
-    "customer_id_nb_tx_1day_window": "int64",
-    "customer_id_nb_tx_7day_window": "int64",
-    "customer_id_nb_tx_14day_window": "int64",
-    "customer_id_avg_amount_1day_window": "float64",
-    "customer_id_avg_amount_7day_window": "float64",
-    "customer_id_avg_amount_14day_window": "float64",
-    "customer_id_nb_tx_15min_window": "int64",
-    "customer_id_avg_amount_15min_window": "float64", 
-    "customer_id_nb_tx_30min_window": "int64",
-    "customer_id_avg_amount_30min_window": "float64", 
-    "customer_id_nb_tx_60min_window": "int64",
-    "customer_id_avg_amount_60min_window":"float64", 
-    "terminal_id_nb_tx_1day_window": "int64",
-    "terminal_id_nb_tx_7day_window": "int64",
-    "terminal_id_nb_tx_14day_window": "int64",
-    "terminal_id_risk_1day_window": "float64",
-    "terminal_id_risk_7day_window": "float64",
-    "terminal_id_risk_14day_window": "float64",
-    "terminal_id_nb_tx_15min_window": "int64",
-    "terminal_id_avg_amount_15min_window": "float64", 
-    "terminal_id_nb_tx_30min_window": "int64",
-    "terminal_id_avg_amount_30min_window":"float64", 
-    "terminal_id_nb_tx_60min_window": "int64",
-    "terminal_id_avg_amount_60min_window": "float64"
-}
-
-
-# Instantiate Vertex AI Feature Store object
-try:
-    ff_feature_store = Featurestore(FEATURESTORE_ID)
-except NameError:
-    print(f"""The feature store {FEATURESTORE_ID} does not exist!""")
 
-# Instantiate the Vertex AI endpoint object
-aiplatform.init(project=PROJECT_ID, location=REGION)
-endpoint_obj = aiplatform.Endpoint(ENDPOINT_ID)
+# Vertex AI clients, created by warm_up()
+ff_feature_store = None
+entity_types = {}
+endpoint_obj = None
+local_model = None
+warmup_ready = threading.Event()
+# exit code of a worker that failed to boot (gunicorn.arbiter.Arbiter.WORKER_BOOT_ERROR)
+WORKER_BOOT_ERROR = 3
+warmup_status = {"ready": False, "error": None, "timings_ms": {}}
+
+def warm_up_once(timings):
+    '''
+    Function that creates the Vertex AI clients, resolves the entity types once and
+    opens the gRPC channels with a first read and prediction, recording how long each step took
+    '''
+    global ff_feature_store, endpoint_obj, local_model
+    start = time.perf_counter()
+
+    def record(step):
+        nonlocal start
+        now = time.perf_counter()
+        timings[step] = round((now - start) * 1000, 1)
+        start = now
+
+    # heavy client libraries are imported here, off the import path of the module
+    from google.cloud import aiplatform
+    record("import")
+
+    aiplatform.init(project=PROJECT_ID, location=REGION)
+    ff_feature_store = aiplatform.Featurestore(FEATURESTORE_ID)
+    for entity in ("customer", "terminal"):
+        entity_types[entity] = ff_feature_store.get_entity_type(entity)
+    record("featurestore")
+    for entity_type in entity_types.values():
+        entity_type.read(entity_ids=["warmup"], feature_ids="*")
+    record("featurestore_read")
+
+    if SCORING_MODE == "endpoint":
+        endpoint_obj = aiplatform.Endpoint(ENDPOINT_ID)
+    else:
+        feature_names = model_feature_names(MODEL_FEATURE_COLUMNS, PREPROCESSOR_PATH)
+        local_model = LocalModel(download_model(MODEL_PATH), list(PAYLOAD_SCHEMA), feature_names,
+                                 max_batch_size=PREDICT_BATCH_MAX_SIZE)
+    record("model")
+    if WARMUP_PREDICT:
+        predict_instances([payload_builder.build(0.0, {})])
+        record("predict")
+
+def warm_up(attempts=WARMUP_ATTEMPTS, backoff=WARMUP_BACKOFF):
+    '''
+    Function that runs the warm-up, retrying transient failures with exponential backoff.
+    An instance that cannot warm up exits so that Cloud Run replaces it
+    '''
+    timings = warmup_status["timings_ms"]
+    for attempt in range(1, attempts + 1):
+        timings.clear()
+        try:
+            warm_up_once(timings)
+            break
+        except Exception as e:
+            warmup_status["error"] = repr(e)
+            print(f"error: warm-up attempt {attempt}/{attempts} failed: {e!r}")
+            if attempt == attempts:
+                # a plain exit only gets the worker respawned by the gunicorn master, while
+                # the boot error code halts the master, and with it the container
+                os._exit(WORKER_BOOT_ERROR)
+            time.sleep(backoff * 2 ** (attempt - 1))
+        finally:
+            timings["total"] = round(sum(v for k, v in timings.items() if k != "total"), 1)
+
+    warmup_status.update(ready=True, error=None)
+    warmup_ready.set()
+    print(f"Warm-up finished: {timings}")
+
+# Compile the payload layout from the schema
+payload_builder = PayloadBuilder(PAYLOAD_SCHEMA)
+
+# Per-stage latency histograms, exported on /metrics
+metrics = LatencyMetrics()
 
-def features_lookup(ff_feature_store, entity, entity_ids):
+# Instantiate the in-process feature cache
+feature_cache = None
+if FEATURE_CACHE_ENABLED:
+    feature_cache = FeatureCache(
+        max_size=FEATURE_CACHE_MAX_SIZE,
+        ttls={"customer": FEATURE_CACHE_CUSTOMER_TTL, "terminal": FEATURE_CACHE_TERMINAL_TTL},
+    )
+
+# Thread pool used to issue the customer and terminal lookups concurrently
+lookup_executor = ThreadPoolExecutor(max_workers=FEATURE_LOOKUP_WORKERS,
+                                     thread_name_prefix="features_lookup")
+
+def read_entities(entity, entity_ids):
     '''
-    Function that retrieves feature values from Vertex AI Feature Store
+    Function that reads several entities of the same type from Vertex AI Feature Store
+    in a single call and returns their feature rows in the order of `entity_ids`
     '''
-    entity_type = ff_feature_store.get_entity_type(entity)
-    aggregated_features = entity_type.read(entity_ids=entity_ids,feature_ids="*")
-    aggregated_features_preprocessed = preprocess(aggregated_features)
-    features = aggregated_features_preprocessed.iloc[0].to_dict()
+    unique_ids = list(dict.fromkeys(str(entity_id) for entity_id in entity_ids))
+    aggregated_features = entity_types[entity].read(entity_ids=unique_ids,feature_ids="*")
+    matrix = payload_builder.entity_matrix(entity, aggregated_features)
+    rows = dict(zip(aggregated_features["entity_id"].astype(str), matrix))
+    return [rows.get(str(entity_id)) for entity_id in entity_ids]
+
+# Instantiate one coalescing reader per entity type
+feature_readers = {}
+if FEATURE_LOOKUP_MAX_BATCH > 1:
+    for entity in ("customer", "terminal"):
+        feature_readers[entity] = MicroBatcher(
+            partial(read_entities, entity),
+            max_batch_size=FEATURE_LOOKUP_MAX_BATCH,
+            max_wait_ms=FEATURE_LOOKUP_WINDOW_MS,
+            name=f"{entity}_reader",
+        )
+
+def features_lookup(entity, entity_ids, timings=None):
+    '''
+    Function that retrieves feature values from Vertex AI Feature Store,
+    serving them from the in-process cache when they are still fresh
+    '''
+    entity_id = entity_ids[0]
+    with metrics.time(f"{entity}_lookup", timings):
+        if feature_cache is not None:
+            features = feature_cache.get(entity, entity_id)
+            if features is not None:
+                return features
+
+        if entity in feature_readers:
+            features = feature_readers[entity].submit(entity_id).result(timeout=FEATURE_LOOKUP_TIMEOUT)
+        else:
+            features = read_entities(entity, [entity_id])[0]
+        if features is None:
+            # an entity missing from the Feature Store is scored with null (0.0) features
+            print(f"warning: {entity} {entity_id} not found in the feature store")
+            return payload_builder.entity_vector(entity, {})
+
+        if feature_cache is not None:
+            feature_cache.put(entity, entity_id, features)
+        return features
+
+def features_lookup_many(entity, entity_ids):
+    '''
+    Function that retrieves the feature values of several entities of the same type,
+    reading the ones missing from the cache with a single Feature Store call
+    '''
+    features = [None] * len(entity_ids)
+    if feature_cache is not None:
+        features = [feature_cache.get(entity, entity_id) for entity_id in entity_ids]
+    missing = [i for i, values in enumerate(features) if values is None]
+    if missing:
+        rows = read_entities(entity, [entity_ids[i] for i in missing])
+        for i, values in zip(missing, rows):
+            if values is None:
+                # an entity missing from the Feature Store is scored with null (0.0) features
+                print(f"warning: {entity} {entity_ids[i]} not found in the feature store")
+                features[i] = payload_builder.entity_vector(entity, {})
+                continue
+            features[i] = values
+            if feature_cache is not None:
+                feature_cache.put(entity, entity_ids[i], values)
     return features
 
-def preprocess(payload):
+def predict_instances(rows):
     '''
-    Function that pre-processes the payload values
+    Function that scores a batch of payload rows, either in-process or with a single
+    request to the Vertex AI endpoint
     '''
-    # replace NaN's
-    for key , value in payload.items():
-        if value is None:
-            payload[key] = 0.0
-    return payload
-    
+    if local_model is not None:
+        return local_model.predict(rows)
+    instances = [payload_builder.to_instance(row) for row in rows]
+    result = endpoint_obj.predict(instances=instances)
+    return result.predictions
+
+# Instantiate the batching stage in front of the Vertex AI endpoint
+predict_batcher = None
+if PREDICT_BATCH_MAX_SIZE > 1 and SCORING_MODE == "endpoint":
+    predict_batcher = MicroBatcher(
+        predict_instances,
+        max_batch_size=PREDICT_BATCH_MAX_SIZE,
+        max_wait_ms=PREDICT_BATCH_MAX_WAIT_MS,
+        max_concurrent_batches=PREDICT_MAX_CONCURRENT_BATCHES,
+        name="predict_batcher",
+    )
+
+def predict(payload):
+    '''
+    Function that scores one payload, batched with concurrent requests when enabled
+    '''
+    if predict_batcher is None:
+        return predict_instances([payload])[0]
+    return predict_batcher.submit(payload).result(timeout=PREDICT_TIMEOUT)
+
+def score_batch(transactions):
+    '''
+    Function that scores a batch of decoded transactions with one Feature Store read
+    per entity type and a single prediction call
+    '''
+    customer_features = features_lookup_many("customer", [tx["CUSTOMER_ID"] for tx in transactions])
+    terminal_features = features_lookup_many("terminal", [tx["TERMINAL_ID"] for tx in transactions])
+    rows = [
+        payload_builder.build(tx["TX_AMOUNT"], {"customer": customer, "terminal": terminal})
+        for tx, customer, terminal in zip(transactions, customer_features, terminal_features)
+    ]
+    return predict_instances(rows)
+
 @app.route("/", methods=["POST"])
 def index():
-    envelope = request.get_json()
-    if not envelope:
-        msg = "no Pub/Sub message received"
+    if not warmup_ready.wait(WARMUP_TIMEOUT) or not warmup_status["ready"]:
+        msg = "service is not ready"
         print(f"error: {msg}")
-        return f"Bad Request: {msg}", 400
+        return f"Service Unavailable: {msg}", 503
 
-    if not isinstance(envelope, dict) or "message" not in envelope:
-        msg = "invalid Pub/Sub message format"
-        print(f"error: {msg}")
-        return f"Bad Request: {msg}", 400
-
-    pubsub_message = envelope["message"]
-
-
-    if isinstance(pubsub_message, dict) and "data" in pubsub_message:
-        payload_input = base64.b64decode(pubsub_message["data"]).decode("utf-8").strip()
-        print(f" >> payload input {payload_input}!")
-        # parse payload string into JSON object
-        payload_json = json.loads(payload_input)
-        
-        payload={}
-        payload["tx_amount"] = payload_json["TX_AMOUNT"]
-        
-        # look up the customer features from Vertex AI Feature Store        
-        customer_features = features_lookup(ff_feature_store, "customer",[payload_json["CUSTOMER_ID"]])
-        payload["customer_id_nb_tx_1day_window"] = customer_features["customer_id_nb_tx_1day_window"]
-        payload["customer_id_nb_tx_7day_window"] = customer_features["customer_id_nb_tx_7day_window"]
-        payload["customer_id_nb_tx_14day_window"] = customer_features["customer_id_nb_tx_14day_window"]
-        payload["customer_id_avg_amount_1day_window"] = customer_features["customer_id_avg_amount_1day_window"]
-        payload["customer_id_avg_amount_7day_window"] = customer_features["customer_id_avg_amount_7day_window"]
-        payload["customer_id_avg_amount_14day_window"] = customer_features["customer_id_avg_amount_14day_window"]
-        payload["customer_id_nb_tx_15min_window"] = customer_features["customer_id_nb_tx_15min_window"]
-        payload["customer_id_avg_amount_15min_window"] = customer_features["customer_id_avg_amount_15min_window"]
-        payload["customer_id_nb_tx_30min_window"] = customer_features["customer_id_nb_tx_30min_window"] 
-        payload["customer_id_avg_amount_30min_window"] = customer_features[ "customer_id_avg_amount_30min_window"]
-        payload["customer_id_nb_tx_60min_window"] = customer_features["customer_id_nb_tx_60min_window"]
-        payload["customer_id_avg_amount_60min_window"] = customer_features["customer_id_avg_amount_60min_window"]
-        
-        # look up the terminal features from Vertex AI Feature Store
-        terminal_features = features_lookup(ff_feature_store, "terminal",[payload_json["TERMINAL_ID"]])
-        payload["terminal_id_nb_tx_1day_window"] = terminal_features["terminal_id_nb_tx_1day_window"]
-        payload["terminal_id_nb_tx_7day_window"] = terminal_features["terminal_id_nb_tx_7day_window"]
-        payload["terminal_id_nb_tx_14day_window"] = terminal_features["terminal_id_nb_tx_14day_window"]
-        payload["terminal_id_risk_1day_window"] = terminal_features["terminal_id_risk_1day_window"] 
-        payload["terminal_id_risk_7day_window"] = terminal_features["terminal_id_risk_7day_window"]
-        payload["terminal_id_risk_14day_window"] = terminal_features["terminal_id_risk_14day_window"]
-        payload["terminal_id_nb_tx_15min_window"] = terminal_features["terminal_id_nb_tx_15min_window"]
-        payload["terminal_id_avg_amount_15min_window"] = terminal_features["terminal_id_avg_amount_15min_window"]
-        payload["terminal_id_nb_tx_30min_window"] = terminal_features["terminal_id_nb_tx_30min_window"]
-        payload["terminal_id_avg_amount_30min_window"] = terminal_features["terminal_id_avg_amount_30min_window"]
-        payload["terminal_id_nb_tx_60min_window"] = terminal_features["terminal_id_nb_tx_60min_window"]
-        payload["terminal_id_avg_amount_60min_window"] = terminal_features["terminal_id_avg_amount_60min_window"]
-
-        payload = preprocess(payload)
-        
-        print("-------------------------------------------------------")
-        print(f"[Pre-processed payload to be sent to Vertex AI endpoint]: {payload}")
-        
-        result = endpoint_obj.predict(instances = [payload])
-        
-        print(f"[Prediction result]: {result}")
+    timings = {}
+    try:
+        with metrics.time("decode", timings):
+            payload_json = parse_pubsub_envelope(request.get_json())
+    except ValueError as e:
+        print(f"error: {e}")
+        return f"Bad Request: {e}", 400
+
+    if payload_json is not None:
+        # look up the customer and terminal features from Vertex AI Feature Store concurrently
+        customer_future = lookup_executor.submit(
+            features_lookup, "customer", [payload_json["CUSTOMER_ID"]], timings)
+        terminal_future = lookup_executor.submit(
+            features_lookup, "terminal", [payload_json["TERMINAL_ID"]], timings)
+        _, not_done = wait([customer_future, terminal_future], timeout=FEATURE_LOOKUP_TIMEOUT)
+        if not_done:
+            for future in not_done:
+                future.cancel()
+            msg = f"feature lookup timed out after {FEATURE_LOOKUP_TIMEOUT}s"
+            print(f"error: {msg}")
+            return f"Service Unavailable: {msg}", 503
+        try:
+            customer_features = customer_future.result()
+            terminal_features = terminal_future.result()
+        except (GoogleAPIError, FutureTimeoutError) as e:
+            # transient Feature Store failure: Pub/Sub redelivers the message later
+            msg = f"feature lookup failed: {e!r}"
+            print(f"error: {msg}")
+            return f"Service Unavailable: {msg}", 503
+
+        with metrics.time("payload", timings):
+            payload = payload_builder.build(
+                payload_json["TX_AMOUNT"], {"customer": customer_features, "terminal": terminal_features})
+
+        try:
+            with metrics.time("predict", timings):
+                result = predict(payload)
+        except FutureTimeoutError:
+            msg = f"prediction timed out after {PREDICT_TIMEOUT}s"
+            print(f"error: {msg}")
+            return f"Service Unavailable: {msg}", 503
+
+        log_sampled(LOG_SAMPLE_RATE, "prediction", transaction=payload_json,
+                    payload=payload_builder.to_instance(payload), prediction=result,
+                    latency_ms=timings)
 
     return ("", 204)
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    '''
+    Readiness endpoint reporting the warm-up state and timings, suitable for a
+    Cloud Run startup probe
+    '''
+    return warmup_status, 200 if warmup_status["ready"] else 503
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    '''
+    Exports the stage latency histograms and the feature cache counters in the
+    Prometheus text format
+    '''
+    counters = {}
+    if feature_cache is not None:
+        cache_stats = feature_cache.stats()
+        counters = {
+            "feature_cache_hits_total": cache_stats["hits"],
+            "feature_cache_misses_total": cache_stats["misses"],
+            "feature_cache_evictions_total": cache_stats["evictions"],
+            "feature_cache_size": cache_stats["size"],
+        }
+    return Response(metrics.render(counters), mimetype="text/plain; version=0.0.4")
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    '''
+    Reports the feature cache counters
+    '''
+    if feature_cache is None:
+        return {"feature_cache": {"enabled": False}}
+    return {"feature_cache": dict(enabled=True, **feature_cache.stats())}
+
+# Warm up in the background so the worker starts listening right away
+threading.Thread(target=warm_up, name="warm_up", daemon=True).start()
+
 if __name__ == "__main__":
     PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
 
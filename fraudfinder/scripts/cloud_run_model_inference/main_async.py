@@ -0,0 +1,295 @@
+# Copyright 2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Asyncio-native (ASGI) variant of the Pub/Sub push endpoint in main.py.
+# Feature Store reads and predictions go through the async Vertex AI clients,
+# so a single worker keeps many transactions in flight. Run it with:
+#   gunicorn --bind :$PORT --workers 1 --timeout 0 -k uvicorn.workers.UvicornWorker main_async:app
+
+import os
+import time
+import asyncio
+import contextlib
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+try:
+    from google.api_core.exceptions import GoogleAPIError
+except ImportError:  # local runs without the client library
+    GoogleAPIError = ConnectionError
+from config import (
+    PROJECT_ID, ENDPOINT_ID, FEATURESTORE_ID, REGION, SCORING_MODE, MODEL_PATH,
+    MODEL_FEATURE_COLUMNS, PREPROCESSOR_PATH, FEATURE_CACHE_ENABLED, FEATURE_CACHE_MAX_SIZE,
+    FEATURE_CACHE_CUSTOMER_TTL, FEATURE_CACHE_TERMINAL_TTL, FEATURE_LOOKUP_TIMEOUT,
+    PREDICT_TIMEOUT, WARMUP_PREDICT, WARMUP_ATTEMPTS, WARMUP_BACKOFF, ASYNC_MAX_IN_FLIGHT, ASYNC_QUEUE_TIMEOUT,
+    LOG_SAMPLE_RATE, PAYLOAD_SCHEMA, validate_config,
+)
+from utils import (
+    FeatureCache, PayloadBuilder, LocalModel, LatencyMetrics, download_model, model_feature_names,
+    log_sampled, parse_pubsub_envelope,
+)
+
+validate_config()
+
+API_ENDPOINT = f"{REGION}-aiplatform.googleapis.com"
+ENTITY_TYPE_PATH = "projects/{project}/locations/{region}/featurestores/{featurestore}/entityTypes/{entity}"
+ENDPOINT_PATH = "projects/{project}/locations/{region}/endpoints/{endpoint}"
+
+# Compile the payload layout from the schema
+payload_builder = PayloadBuilder(PAYLOAD_SCHEMA)
+
+# Per-stage latency histograms, exported on /metrics
+metrics = LatencyMetrics()
+
+# Instantiate the in-process feature cache
+feature_cache = None
+if FEATURE_CACHE_ENABLED:
+    feature_cache = FeatureCache(
+        max_size=FEATURE_CACHE_MAX_SIZE,
+        ttls={"customer": FEATURE_CACHE_CUSTOMER_TTL, "terminal": FEATURE_CACHE_TERMINAL_TTL},
+    )
+
+# Async Vertex AI clients, created on startup
+clients = {}
+local_model = None
+in_flight = None
+warmup_status = {"ready": False, "error": None, "timings_ms": {}}
+
+
+async def read_entity(entity, entity_id):
+    '''
+    Function that reads the features of one entity with the async online serving client
+    '''
+    from google.cloud import aiplatform_v1
+
+    request = aiplatform_v1.ReadFeatureValuesRequest(
+        entity_type=ENTITY_TYPE_PATH.format(project=PROJECT_ID, region=REGION,
+                                            featurestore=FEATURESTORE_ID, entity=entity),
+        entity_id=str(entity_id),
+        feature_selector=aiplatform_v1.FeatureSelector(
+            id_matcher=aiplatform_v1.IdMatcher(ids=["*"])),
+    )
+    response = await clients["featurestore"].read_feature_values(
+        request=request, timeout=FEATURE_LOOKUP_TIMEOUT)
+
+    values = {}
+    feature_ids = [descriptor.id for descriptor in response.header.feature_descriptors]
+    for feature_id, data in zip(feature_ids, response.entity_view.data):
+        value_type = aiplatform_v1.FeatureValue.pb(data.value).WhichOneof("value")
+        values[feature_id] = getattr(data.value, value_type) if value_type else None
+    return payload_builder.entity_vector(entity, values)
+
+
+async def features_lookup(entity, entity_id, timings=None):
+    '''
+    Function that retrieves feature values from Vertex AI Feature Store,
+    serving them from the in-process cache when they are still fresh
+    '''
+    with metrics.time(f"{entity}_lookup", timings):
+        if feature_cache is not None:
+            features = feature_cache.get(entity, entity_id)
+            if features is not None:
+                return features
+
+        features = await read_entity(entity, entity_id)
+        if feature_cache is not None:
+            feature_cache.put(entity, entity_id, features)
+        return features
+
+
+async def predict(payload):
+    '''
+    Function that scores one payload, either in-process or with the async prediction client
+    '''
+    if local_model is not None:
+        return local_model.predict([payload])[0]
+
+    from google.cloud import aiplatform_v1
+    from google.protobuf import json_format, struct_pb2
+
+    instance = json_format.ParseDict(payload_builder.to_instance(payload), struct_pb2.Value())
+    response = await clients["prediction"].predict(
+        endpoint=ENDPOINT_PATH.format(project=PROJECT_ID, region=REGION, endpoint=ENDPOINT_ID),
+        instances=[instance],
+        timeout=PREDICT_TIMEOUT,
+    )
+    predictions = aiplatform_v1.PredictResponse.pb(response).predictions
+    return json_format.MessageToDict(predictions[0])
+
+
+async def warm_up_once(timings):
+    '''
+    Creates the async clients and warms up the gRPC channels with a first read and prediction
+    '''
+    global local_model
+    start = time.perf_counter()
+    from google.cloud import aiplatform_v1
+
+    client_options = {"api_endpoint": API_ENDPOINT}
+    clients["featurestore"] = aiplatform_v1.FeaturestoreOnlineServingServiceAsyncClient(
+        client_options=client_options)
+    if SCORING_MODE == "endpoint":
+        clients["prediction"] = aiplatform_v1.PredictionServiceAsyncClient(
+            client_options=client_options)
+    else:
+        feature_names = model_feature_names(MODEL_FEATURE_COLUMNS, PREPROCESSOR_PATH)
+        local_model = LocalModel(download_model(MODEL_PATH), list(PAYLOAD_SCHEMA), feature_names)
+    timings["clients"] = round((time.perf_counter() - start) * 1000, 1)
+
+    start = time.perf_counter()
+    await asyncio.gather(read_entity("customer", "warmup"), read_entity("terminal", "warmup"))
+    if WARMUP_PREDICT:
+        await predict(payload_builder.build(0.0, {}))
+    timings["warmup"] = round((time.perf_counter() - start) * 1000, 1)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    '''
+    Warms up before the server accepts requests, retrying transient failures with
+    exponential backoff
+    '''
+    global in_flight
+    in_flight = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+    timings = warmup_status["timings_ms"]
+    for attempt in range(1, WARMUP_ATTEMPTS + 1):
+        timings.clear()
+        try:
+            await warm_up_once(timings)
+            break
+        except Exception as e:
+            warmup_status["error"] = repr(e)
+            print(f"error: warm-up attempt {attempt}/{WARMUP_ATTEMPTS} failed: {e!r}")
+            if attempt == WARMUP_ATTEMPTS:
+                # failing the startup exits the worker, so that Cloud Run replaces the instance
+                raise
+            await asyncio.sleep(WARMUP_BACKOFF * 2 ** (attempt - 1))
+    warmup_status.update(ready=True, error=None)
+    print(f"Warm-up finished: {timings}")
+    yield
+
+
+async def score_transaction(payload_json, timings=None):
+    # look up the customer and terminal features from Vertex AI Feature Store concurrently
+    customer_features, terminal_features = await asyncio.wait_for(
+        asyncio.gather(
+            features_lookup("customer", payload_json["CUSTOMER_ID"], timings),
+            features_lookup("terminal", payload_json["TERMINAL_ID"], timings),
+        ),
+        timeout=FEATURE_LOOKUP_TIMEOUT,
+    )
+    with metrics.time("payload", timings):
+        payload = payload_builder.build(
+            payload_json["TX_AMOUNT"], {"customer": customer_features, "terminal": terminal_features})
+    with metrics.time("predict", timings):
+        result = await asyncio.wait_for(predict(payload), timeout=PREDICT_TIMEOUT)
+    return payload, result
+
+
+async def index(request):
+    timings = {}
+    try:
+        envelope = await request.json()
+    except ValueError:
+        envelope = None
+    try:
+        with metrics.time("decode", timings):
+            payload_json = parse_pubsub_envelope(envelope)
+    except ValueError as e:
+        print(f"error: {e}")
+        return PlainTextResponse(f"Bad Request: {e}", status_code=400)
+
+    if payload_json is None:
+        return Response(status_code=204)
+
+    # backpressure: when every slot stays busy, reject so that Pub/Sub redelivers later
+    try:
+        await asyncio.wait_for(in_flight.acquire(), timeout=ASYNC_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        msg = f"more than {ASYNC_MAX_IN_FLIGHT} transactions in flight"
+        print(f"error: {msg}")
+        return PlainTextResponse(f"Too Many Requests: {msg}", status_code=429)
+
+    try:
+        payload, result = await score_transaction(payload_json, timings)
+    except asyncio.TimeoutError:
+        msg = "feature lookup or prediction timed out"
+        print(f"error: {msg}")
+        return PlainTextResponse(f"Service Unavailable: {msg}", status_code=503)
+    except GoogleAPIError as e:
+        # transient Feature Store or endpoint failure: Pub/Sub redelivers the message later
+        msg = f"feature lookup or prediction failed: {e!r}"
+        print(f"error: {msg}")
+        return PlainTextResponse(f"Service Unavailable: {msg}", status_code=503)
+    finally:
+        in_flight.release()
+
+    log_sampled(LOG_SAMPLE_RATE, "prediction", transaction=payload_json,
+                payload=payload_builder.to_instance(payload), prediction=result,
+                latency_ms=timings)
+    return Response(status_code=204)
+
+
+async def ready(request):
+    '''
+    Readiness endpoint reporting the warm-up state and timings
+    '''
+    return JSONResponse(warmup_status, status_code=200 if warmup_status["ready"] else 503)
+
+
+async def prometheus_metrics(request):
+    '''
+    Exports the stage latency histograms and the feature cache counters in the
+    Prometheus text format
+    '''
+    counters = {}
+    if feature_cache is not None:
+        cache_stats = feature_cache.stats()
+        counters = {
+            "feature_cache_hits_total": cache_stats["hits"],
+            "feature_cache_misses_total": cache_stats["misses"],
+            "feature_cache_evictions_total": cache_stats["evictions"],
+            "feature_cache_size": cache_stats["size"],
+        }
+    return PlainTextResponse(metrics.render(counters), media_type="text/plain; version=0.0.4")
+
+
+async def stats(request):
+    '''
+    Reports the feature cache counters
+    '''
+    if feature_cache is None:
+        return JSONResponse({"feature_cache": {"enabled": False}})
+    return JSONResponse({"feature_cache": dict(enabled=True, **feature_cache.stats())})
+
+
+app = Starlette(
+    routes=[
+        Route("/", index, methods=["POST"]),
+        Route("/ready", ready, methods=["GET"]),
+        Route("/metrics", prometheus_metrics, methods=["GET"]),
+        Route("/stats", stats, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    PORT = int(os.getenv("PORT")) if os.getenv("PORT") else 8080
+
+    # This is used when running locally. Gunicorn with uvicorn workers is used to
+    # run the application on Cloud Run.
+    uvicorn.run(app, host="127.0.0.1", port=PORT)
@@ -0,0 +1,237 @@
+# Copyright 2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Streaming consumer mode of the inference service. Instead of one HTTP push per
+# transaction, transactions are pulled from SUBSCRIPTION_PATH in batches, enriched
+# with one Feature Store read per entity type, scored with a single call and acked
+# together. Run it with:
+#   python streaming.py
+# Set PUBSUB_EMULATOR_HOST to run it against a local Pub/Sub emulator.
+
+import json
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    from google.api_core.exceptions import DeadlineExceeded
+except ImportError:  # in-memory fakes of the subscriber do not need the client library
+    DeadlineExceeded = TimeoutError
+
+from config import (
+    SUBSCRIPTION_PATH, STREAM_MAX_MESSAGES, STREAM_MAX_CONCURRENT_BATCHES, STREAM_PULL_TIMEOUT,
+    STREAM_DEAD_LETTER_TOPIC,
+)
+
+# Errors raised by a transaction that would fail again on every redelivery: a missing
+# (KeyError) or invalid (TypeError, ValueError) field
+DATA_ERRORS = (KeyError, TypeError, ValueError)
+
+
+class StreamingScorer:
+    '''
+    Pulls transactions from a Pub/Sub subscription in batches and scores every batch with
+    a single `score_batch` call. A batch is acknowledged only once it has been scored,
+    otherwise its messages are nacked so that Pub/Sub redelivers them (at-least-once).
+    Flow control: at most `max_concurrent_batches` batches of `max_messages` are outstanding.
+
+    When a batch fails, its transactions are scored one by one: messages that fail for data
+    reasons (malformed JSON, missing or invalid field) are passed to
+    `on_dead_letter` and acked, only the other failures are nacked.
+
+    `subscriber` is a `pubsub_v1.SubscriberClient` or any object with the same
+    `pull`, `acknowledge` and `modify_ack_deadline` methods.
+    '''
+
+    def __init__(self, subscriber: Any, subscription_path: str,
+                 score_batch: Callable[[List[Dict[str, Any]]], List[Any]],
+                 max_messages: int = 100, max_concurrent_batches: int = 2, pull_timeout: float = 30.0,
+                 on_dead_letter: Optional[Callable[[Any, Exception], None]] = None):
+        self.subscriber = subscriber
+        self.subscription_path = subscription_path
+        self.score_batch = score_batch
+        self.max_messages = max_messages
+        self.pull_timeout = pull_timeout
+        self.on_dead_letter = on_dead_letter
+        self.scored = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self._slots = threading.BoundedSemaphore(max_concurrent_batches)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches,
+                                            thread_name_prefix="stream_scorer")
+        self._stopped = threading.Event()
+
+    def pull(self) -> List[Any]:
+        response = self.subscriber.pull(
+            request={"subscription": self.subscription_path, "max_messages": self.max_messages},
+            timeout=self.pull_timeout,
+        )
+        return list(response.received_messages)
+
+    def acknowledge(self, ack_ids: List[str]) -> None:
+        if ack_ids:
+            self.subscriber.acknowledge(
+                request={"subscription": self.subscription_path, "ack_ids": ack_ids})
+
+    def nack(self, ack_ids: List[str]) -> None:
+        if ack_ids:
+            self.subscriber.modify_ack_deadline(
+                request={"subscription": self.subscription_path, "ack_ids": ack_ids,
+                         "ack_deadline_seconds": 0})
+
+    def dead_letter(self, received: Any, error: Exception) -> None:
+        '''
+        Forwards a message that can never be scored to the dead-letter handler, then acks it
+        '''
+        print(f"error: dropping message {received.message.message_id}: {error!r}")
+        if self.on_dead_letter is not None:
+            self.on_dead_letter(received, error)
+        self.acknowledge([received.ack_id])
+        self.dead_lettered += 1
+
+    def score_each(self, transactions: List[Dict[str, Any]], received_messages: List[Any]) -> List[Any]:
+        '''
+        Scores the transactions of a failed batch one by one, so that a poison message does
+        not send the good ones back for redelivery. Data errors (missing or invalid field)
+        are dead-lettered, other failures are nacked for that message only.
+        '''
+        results, ack_ids, nack_ids = [], [], []
+        for transaction, received in zip(transactions, received_messages):
+            try:
+                results.append(self.score_batch([transaction])[0])
+                ack_ids.append(received.ack_id)
+            except DATA_ERRORS as e:
+                self.dead_letter(received, e)
+                results.append(None)
+            except Exception as e:
+                print(f"error: scoring message {received.message.message_id} failed: {e!r}")
+                nack_ids.append(received.ack_id)
+                results.append(None)
+        self.acknowledge(ack_ids)
+        self.nack(nack_ids)
+        self.scored += len(ack_ids)
+        self.failed += len(nack_ids)
+        return results
+
+    def process(self, received_messages: List[Any]) -> Optional[List[Any]]:
+        '''
+        Decodes, scores and acknowledges one batch of received messages. Results are returned
+        in the order of the decoded transactions, None for the ones that could not be scored.
+        '''
+        transactions, decoded = [], []
+        for received in received_messages:
+            try:
+                transactions.append(json.loads(received.message.data.decode("utf-8")))
+                decoded.append(received)
+            except ValueError as e:
+                # a malformed message would never succeed, so it is never redelivered
+                self.dead_letter(received, e)
+        if not transactions:
+            return []
+
+        try:
+            results = self.score_batch(transactions)
+        except Exception as e:
+            print(f"error: scoring a batch of {len(transactions)} transactions failed: {e!r}, "
+                  "scoring them one by one")
+            return self.score_each(transactions, decoded)
+
+        self.acknowledge([received.ack_id for received in decoded])
+        self.scored += len(decoded)
+        print(f"[Scored batch]: {len(transactions)} transactions")
+        return results
+
+    def run_once(self) -> Optional[List[Any]]:
+        '''
+        Pulls and processes a single batch in the calling thread
+        '''
+        return self.process(self.pull())
+
+    def batch_done(self, future: Any, received_messages: List[Any]) -> None:
+        '''
+        Frees the batch slot and, when process() itself raised (e.g. while acking or
+        dead-lettering), nacks the whole batch so that it is redelivered right away
+        instead of when its ack deadline expires
+        '''
+        try:
+            error = future.exception()
+            if error is not None:
+                print(f"error: processing a batch of {len(received_messages)} messages failed: {error!r}")
+                self.nack([received.ack_id for received in received_messages])
+        except Exception as e:
+            print(f"error: nacking the failed batch failed: {e!r}")
+        finally:
+            self._slots.release()
+
+    def run(self) -> None:
+        '''
+        Pulls batches until stop() is called, scoring them on the worker threads
+        '''
+        while not self._stopped.is_set():
+            self._slots.acquire()
+            try:
+                received_messages = self.pull()
+            except DeadlineExceeded:
+                received_messages = []
+            except Exception as e:
+                print(f"error: pull from {self.subscription_path} failed: {e!r}")
+                received_messages = []
+
+            if not received_messages or self._stopped.is_set():
+                self.nack([received.ack_id for received in received_messages])
+                self._slots.release()
+                continue
+            future = self._executor.submit(self.process, received_messages)
+            future.add_done_callback(lambda future, batch=received_messages: self.batch_done(future, batch))
+        self._executor.shutdown(wait=True)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+if __name__ == "__main__":
+    from google.cloud import pubsub_v1
+    import main as service
+
+    if not SUBSCRIPTION_PATH:
+        raise ValueError("SUBSCRIPTION_PATH variable must be set.")
+
+    # the service module creates the Vertex AI clients in the background
+    service.warmup_ready.wait()
+    if not service.warmup_status["ready"]:
+        raise RuntimeError(f"warm-up failed: {service.warmup_status['error']}")
+
+    on_dead_letter = None
+    if STREAM_DEAD_LETTER_TOPIC:
+        publisher = pubsub_v1.PublisherClient()
+
+        def on_dead_letter(received, error):
+            publisher.publish(STREAM_DEAD_LETTER_TOPIC, received.message.data, error=repr(error)).result()
+
+    scorer = StreamingScorer(
+        pubsub_v1.SubscriberClient(),
+        SUBSCRIPTION_PATH,
+        service.score_batch,
+        max_messages=STREAM_MAX_MESSAGES,
+        max_concurrent_batches=STREAM_MAX_CONCURRENT_BATCHES,
+        pull_timeout=STREAM_PULL_TIMEOUT,
+        on_dead_letter=on_dead_letter,
+    )
+    signal.signal(signal.SIGTERM, lambda *_: scorer.stop())
+    print(f"Pulling transactions from {SUBSCRIPTION_PATH}")
+    try:
+        scorer.run()
+    except KeyboardInterrupt:
+        scorer.stop()
@@ -0,0 +1,115 @@
+# Copyright 2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of the streaming consumer against an in-memory fake of the Pub/Sub subscriber.
+# Run locally with: python -m pytest test_streaming.py (or python test_streaming.py)
+
+import json
+import threading
+import unittest
+from types import SimpleNamespace
+
+from streaming import StreamingScorer
+
+
+def received(i, data):
+    if not isinstance(data, bytes):
+        data = json.dumps(data).encode("utf-8")
+    return SimpleNamespace(ack_id=f"ack-{i}", message=SimpleNamespace(message_id=str(i), data=data))
+
+
+class FakeSubscriber:
+    '''
+    In-memory subscriber: pull() hands out the queued batches, then empty ones
+    '''
+
+    def __init__(self, batches=()):
+        self.batches = list(batches)
+        self.acked, self.nacked = [], []
+        self.lock = threading.Lock()
+        self.drained = threading.Event()
+
+    def pull(self, request, timeout):
+        with self.lock:
+            if not self.batches:
+                self.drained.set()
+                return SimpleNamespace(received_messages=[])
+            return SimpleNamespace(received_messages=self.batches.pop(0))
+
+    def acknowledge(self, request):
+        with self.lock:
+            self.acked.extend(request["ack_ids"])
+
+    def modify_ack_deadline(self, request):
+        with self.lock:
+            self.nacked.extend(request["ack_ids"])
+
+
+def score(transactions):
+    for transaction in transactions:
+        if transaction["CUSTOMER_ID"] == "transient":
+            raise ConnectionError("feature store unavailable")
+        # a missing field raises a KeyError, as in score_batch
+        transaction["TX_AMOUNT"]
+    return [transaction["CUSTOMER_ID"] for transaction in transactions]
+
+
+class StreamingScorerTest(unittest.TestCase):
+
+    def test_batch_is_scored_and_acked(self):
+        subscriber = FakeSubscriber()
+        scorer = StreamingScorer(subscriber, "subscription", score)
+        messages = [received(i, {"CUSTOMER_ID": f"c{i}", "TX_AMOUNT": 1.0}) for i in range(3)]
+        self.assertEqual(scorer.process(messages), ["c0", "c1", "c2"])
+        self.assertEqual(sorted(subscriber.acked), ["ack-0", "ack-1", "ack-2"])
+        self.assertEqual(subscriber.nacked, [])
+        self.assertEqual(scorer.scored, 3)
+
+    def test_poison_messages_do_not_nack_the_batch(self):
+        subscriber = FakeSubscriber()
+        dead_letters = []
+        scorer = StreamingScorer(subscriber, "subscription", score,
+                                 on_dead_letter=lambda message, error: dead_letters.append(message.ack_id))
+        messages = [
+            received(0, {"CUSTOMER_ID": "c0", "TX_AMOUNT": 1.0}),
+            received(1, {"CUSTOMER_ID": "c1"}),
+            received(2, b"not json"),
+            received(3, {"CUSTOMER_ID": "transient", "TX_AMOUNT": 1.0}),
+            received(4, {"CUSTOMER_ID": "c4", "TX_AMOUNT": 1.0}),
+        ]
+        self.assertEqual(scorer.process(messages), ["c0", None, None, "c4"])
+        self.assertEqual(sorted(dead_letters), ["ack-1", "ack-2"])
+        self.assertEqual(sorted(subscriber.acked), ["ack-0", "ack-1", "ack-2", "ack-4"])
+        self.assertEqual(subscriber.nacked, ["ack-3"])
+        self.assertEqual((scorer.scored, scorer.failed, scorer.dead_lettered), (2, 1, 2))
+
+    def test_run_nacks_a_batch_whose_processing_raises(self):
+        def failing_dead_letter(message, error):
+            raise RuntimeError("dead-letter topic unavailable")
+
+        batch = [received(0, b"not json"), received(1, {"CUSTOMER_ID": "c1", "TX_AMOUNT": 1.0})]
+        subscriber = FakeSubscriber([batch])
+        scorer = StreamingScorer(subscriber, "subscription", score, max_concurrent_batches=1,
+                                 on_dead_letter=failing_dead_letter)
+        runner = threading.Thread(target=scorer.run)
+        runner.start()
+        self.assertTrue(subscriber.drained.wait(5))
+        scorer.stop()
+        runner.join(5)
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(sorted(subscriber.nacked), ["ack-0", "ack-1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,371 @@
+# Copyright 2022 Google, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import base64
+import random
+import contextlib
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+def parse_pubsub_envelope(envelope: Any) -> Optional[Dict[str, Any]]:
+    '''
+    Validates a Pub/Sub push envelope and returns the transaction it carries,
+    or None when the message has no data. Raises ValueError for malformed envelopes.
+    '''
+    if not envelope:
+        raise ValueError("no Pub/Sub message received")
+    if not isinstance(envelope, dict) or "message" not in envelope:
+        raise ValueError("invalid Pub/Sub message format")
+
+    pubsub_message = envelope["message"]
+    if not isinstance(pubsub_message, dict) or "data" not in pubsub_message:
+        return None
+    payload_input = base64.b64decode(pubsub_message["data"]).decode("utf-8").strip()
+    # parse payload string into JSON object
+    return json.loads(payload_input)
+
+
+class FeatureCache:
+    '''
+    Bounded in-memory LRU cache of Feature Store values keyed by (entity type, entity id).
+    Every entity type has its own time-to-live, so that cached values never lag
+    behind the streaming aggregates for longer than the configured TTL.
+    '''
+
+    def __init__(self, max_size: int, ttls: Dict[str, float]):
+        self.max_size = max_size
+        self.ttls = ttls
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entity: str, entity_id: Hashable) -> Optional[Any]:
+        '''
+        Returns the cached features of an entity, or None if missing or expired
+        '''
+        key = (entity, entity_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, entity: str, entity_id: Hashable, features: Any) -> None:
+        '''
+        Stores the features of an entity, evicting the least recently used entries
+        '''
+        ttl = self.ttls.get(entity, 0)
+        if ttl <= 0:
+            return
+        key = (entity, entity_id)
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (expires_at, features)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class MicroBatcher:
+    '''
+    Collects items submitted by concurrent request threads and hands them to
+    `process_batch` in a single call. A batch is flushed when it holds
+    `max_batch_size` items or when its first item has waited `max_wait_ms`,
+    whichever comes first. `process_batch` must return one result per item,
+    in order, and every caller gets back a Future for its own result.
+    '''
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]], max_batch_size: int,
+                 max_wait_ms: float, max_concurrent_batches: int = 1, name: str = "micro_batcher"):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._executor = None
+        if max_concurrent_batches > 1:
+            self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches,
+                                                thread_name_prefix=name)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if self._executor is not None:
+                self._executor.submit(self._flush, batch)
+            else:
+                self._flush(batch)
+
+    def _flush(self, batch: List[Any]) -> None:
+        # callers that already gave up on their result are dropped from the batch
+        batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        items = [item for item, _ in batch]
+        try:
+            results = self.process_batch(items)
+            if len(results) != len(items):
+                raise ValueError(f"expected {len(items)} results, got {len(results)}")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+class LatencyMetrics:
+    '''
+    Thread-safe latency histograms, one per request stage, rendered in the
+    Prometheus text exposition format.
+    '''
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str = "inference_stage_latency_seconds", buckets: tuple = BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = {"buckets": [0] * len(self.buckets),
+                                                       "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, stage: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+        '''
+        Times the enclosed block, also recording it in milliseconds in `timings` when given
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(stage, seconds)
+            if timings is not None:
+                timings[stage] = round(seconds * 1000, 3)
+
+    def render(self, counters: Optional[Dict[str, float]] = None) -> str:
+        lines = [f"# HELP {self.name} Latency of each stage of an inference request.",
+                 f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{self.name}_sum{{stage="{stage}"}} {histogram["sum"]}')
+                lines.append(f'{self.name}_count{{stage="{stage}"}} {histogram["count"]}')
+        for name, value in (counters or {}).items():
+            lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def log_sampled(sample_rate: float, message: str, **fields: Any) -> None:
+    '''
+    Writes a structured (JSON) log line for a random sample of the calls.
+    Cloud Run parses JSON lines written to stdout as structured log entries.
+    '''
+    if sample_rate > 0 and random.random() < sample_rate:
+        print(json.dumps(dict(severity="INFO", message=message, **fields), default=str))
+
+
+def download_model(model_uri: str, local_dir: str = "/tmp") -> str:
+    '''
+    Downloads a model artifact from GCS once and returns its local path.
+    Local paths are returned unchanged.
+    '''
+    if not model_uri.startswith("gs://"):
+        return model_uri
+
+    from google.cloud import storage
+
+    local_path = os.path.join(local_dir, os.path.basename(model_uri))
+    blob = storage.Blob.from_string(model_uri, client=storage.Client())
+    blob.download_to_filename(local_path)
+    print(f"Model downloaded from {model_uri} to {local_path}")
+    return local_path
+
+
+def model_feature_names(feature_columns: Optional[str] = None,
+                        preprocessor_path: Optional[str] = None) -> Optional[List[str]]:
+    '''
+    Returns the column order the model was trained on, read from the preprocessor
+    saved with the model or from a comma separated list, None when neither is set
+    '''
+    if preprocessor_path:
+        with open(download_model(preprocessor_path)) as f:
+            return json.load(f)["feature_columns"]
+    if feature_columns:
+        return feature_columns.split(",")
+    return None
+
+
+class PayloadBuilder:
+    '''
+    Assembles prediction payloads as float32 rows in the fixed column order of a
+    payload schema. Columns named `<entity>_id_*` are filled from that entity's
+    Feature Store values, nulls are replaced with 0.0 while the values are converted.
+    '''
+
+    def __init__(self, schema: Dict[str, str], entities: List[str] = ("customer", "terminal")):
+        self.columns = list(schema)
+        self.index = {name: i for i, name in enumerate(self.columns)}
+        self.entity_columns = {
+            entity: [name for name in self.columns if name.startswith(f"{entity}_id_")]
+            for entity in entities
+        }
+        self.entity_slots = {
+            entity: np.array([self.index[name] for name in names])
+            for entity, names in self.entity_columns.items()
+        }
+        self.integer_slots = [i for i, name in enumerate(self.columns)
+                              if schema[name].startswith("int")]
+
+    def entity_matrix(self, entity: str, features) -> np.ndarray:
+        '''
+        Converts the DataFrame returned by `EntityType.read` into one float32 row per entity
+        '''
+        column_positions = {name: i for i, name in enumerate(features.columns)}
+        positions = np.array([column_positions.get(name, -1) for name in self.entity_columns[entity]])
+        found = positions >= 0
+        values = features.to_numpy()[:, positions[found]]
+        values[pd.isna(values)] = 0.0
+        matrix = np.zeros((len(features), len(positions)), dtype=np.float32)
+        matrix[:, found] = values
+        return matrix
+
+    def entity_vector(self, entity: str, values: Dict[str, Any]) -> np.ndarray:
+        '''
+        Converts the feature values of a single entity, keyed by feature id, into a float32 row
+        '''
+        return np.array([values.get(name) if values.get(name) is not None else 0.0
+                         for name in self.entity_columns[entity]], dtype=np.float32)
+
+    def build(self, tx_amount: Optional[float], entity_features: Dict[str, np.ndarray],
+              out: Optional[np.ndarray] = None) -> np.ndarray:
+        row = out if out is not None else np.zeros(len(self.columns), dtype=np.float32)
+        row[self.index["tx_amount"]] = tx_amount or 0.0
+        for entity, values in entity_features.items():
+            row[self.entity_slots[entity]] = values
+        return row
+
+    def to_instance(self, row: np.ndarray) -> Dict[str, Any]:
+        '''
+        Converts a row back to the JSON instance expected by the Vertex AI endpoint
+        '''
+        values = row.tolist()
+        for i in self.integer_slots:
+            values[i] = int(values[i])
+        return dict(zip(self.columns, values))
+
+
+class LocalModel:
+    '''
+    XGBoost booster (the `model.bst` written by the custom trainer) scored in-process.
+    Rows arrive in the order of `columns` and are copied into a preallocated float32
+    matrix whose columns follow the model's feature order, one matrix per request thread.
+    '''
+
+    def __init__(self, model_path: str, columns: List[str], feature_names: Optional[List[str]] = None,
+                 max_batch_size: int = 8):
+        import xgboost as xgb
+
+        self.booster = xgb.Booster()
+        self.booster.load_model(model_path)
+        # a booster trained on a named DataFrame knows its own column order
+        self.feature_names = list(self.booster.feature_names or feature_names or columns)
+        if self.booster.num_features() != len(self.feature_names):
+            raise ValueError(f"model expects {self.booster.num_features()} features, "
+                             f"got {len(self.feature_names)} feature names")
+        self._order = None
+        if self.feature_names != list(columns):
+            self._order = np.array([list(columns).index(name) for name in self.feature_names])
+        self.max_batch_size = max_batch_size
+        self._buffers = threading.local()
+
+    def _matrix(self, n_rows: int) -> np.ndarray:
+        matrix = getattr(self._buffers, "matrix", None)
+        if matrix is None or matrix.shape[0] < n_rows:
+            matrix = np.empty((max(n_rows, self.max_batch_size), len(self.feature_names)),
+                              dtype=np.float32)
+            self._buffers.matrix = matrix
+        return matrix[:n_rows]
+
+    def predict(self, rows: List[np.ndarray]) -> List[float]:
+        matrix = self._matrix(len(rows))
+        for i, row in enumerate(rows):
+            matrix[i] = row if self._order is None else row[self._order]
+        return self.booster.inplace_predict(matrix).tolist()
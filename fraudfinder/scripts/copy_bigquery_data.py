@@ -1,7 +1,88 @@
+import os
 import sys
-from typing import Union
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
 import pandas as pd
 
+try:
+    from google.api_core.exceptions import NotFound
+except ImportError:  # local fakes of the clients do not need the client library
+    NotFound = LookupError
+
+# Connections kept open by each client, enough for the concurrent blob and table copies
+CLIENT_POOL_SIZE = int(os.environ.get("CLIENT_POOL_SIZE", 32))
+
+SOURCE_BUCKET = "cymbal-fraudfinder"
+
+# Files needed for datagen streaming, copied under the same name
+DATAGEN_BLOBS = [
+    "datagen/hacked_customers_history.txt",
+    "datagen/hacked_terminals_history.txt",
+    "datagen/demographics/customer_profiles.csv",
+    "datagen/demographics/terminal_profiles.csv",
+    "datagen/demographics/customer_with_terminal_profiles.csv",
+]
+
+BQ_LOCATION = "us-central1"
+BQ_DATASETS = ["tx", "demographics"]
+
+# Tables copied from the public tables: (target table, source table, CREATE TABLE statement)
+BQ_TABLES = [
+    ("tx.tx", "cymbal-fraudfinder.txbackup.all", """
+    CREATE OR REPLACE TABLE `{PROJECT}`.tx.tx 
+    PARTITION BY
+    DATE(TX_TS)
+    AS (
+        SELECT
+        TX_ID,
+        TX_TS,
+        CUSTOMER_ID,
+        TERMINAL_ID,
+        TX_AMOUNT
+        FROM
+        `cymbal-fraudfinder`.txbackup.all
+    );
+    """),
+    ("tx.txlabels", "cymbal-fraudfinder.txbackup.all", """
+    CREATE OR REPLACE TABLE `{PROJECT}`.tx.txlabels
+    AS (
+        SELECT
+        TX_ID,
+        TX_FRAUD
+        FROM
+        `cymbal-fraudfinder`.txbackup.all
+    );
+    """),
+    ("demographics.customers", "cymbal-fraudfinder.demographics.customers", """
+    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.customers
+    AS (
+        SELECT
+        *
+        FROM
+        `cymbal-fraudfinder`.demographics.customers
+    );
+    """),
+    ("demographics.terminals", "cymbal-fraudfinder.demographics.terminals", """
+    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.terminals
+    AS (
+        SELECT
+        *
+        FROM
+        `cymbal-fraudfinder`.demographics.terminals
+    );
+    """),
+    ("demographics.customersterminals", "cymbal-fraudfinder.demographics.customersterminals", """
+    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.customersterminals
+    AS (
+        SELECT
+        *
+        FROM
+        `cymbal-fraudfinder`.demographics.customersterminals
+    );
+    """),
+]
+
 def get_project_id():
     import urllib.request
     url = "http://metadata.google.internal/computeMetadata/v1/project/project-id"
@@ -22,19 +103,57 @@ def get_project_id():
 
     return project_id
 
-def run_bq_query(sql: str) -> Union[str, pd.DataFrame]:
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(kind: str, project: str = None, location: str = None):
+    """
+    Returns the "storage" or "bigquery" client of (project, location), created on
+    first use and shared by all threads, with a connection pool of CLIENT_POOL_SIZE.
+    The scripts run on their own, so this is vertex_ai/utils.py's shared_client
+    reduced to the two clients the bootstrap needs.
+    """
+    key = (kind, project, location)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                import google.auth
+                import requests
+                from google.auth.transport.requests import AuthorizedSession
+
+                credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+                session = AuthorizedSession(credentials)
+                session.mount("https://", requests.adapters.HTTPAdapter(
+                    pool_connections=CLIENT_POOL_SIZE, pool_maxsize=CLIENT_POOL_SIZE))
+                if kind == "storage":
+                    from google.cloud import storage
+                    client = storage.Client(project=project, _http=session)
+                elif kind == "bigquery":
+                    from google.cloud import bigquery
+                    client = bigquery.Client(project=project, location=location, _http=session)
+                else:
+                    raise ValueError(f"unknown client kind {kind}")
+                _clients[key] = client
+    return client
+
+def run_bq_query(sql: str, dry_run: bool = False) -> Union[str, pd.DataFrame]:
     """
     Input: SQL query, as a string, to execute in BigQuery
+    Set dry_run to validate the query with a dry run before running it
     Returns the query results as a pandas DataFrame, or error, if any
     """
     
     from google.cloud import bigquery
     
-    bq_client = bigquery.Client()
+    bq_client = get_client("bigquery")
     
-    # Try dry run before executing query to catch any errors
-    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
-    bq_client.query(sql, job_config=job_config)
+    if dry_run:
+        # Try dry run before executing query to catch any errors
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        bq_client.query(sql, job_config=job_config)
 
     # If dry run succeeds without errors, proceed to run query
     job_config = bigquery.QueryJobConfig()
@@ -48,20 +167,29 @@ def run_bq_query(sql: str) -> Union[str, pd.DataFrame]:
     return df
 
 def copy_blob(
-    bucket_name, blob_name, destination_bucket_name, destination_blob_name
+    bucket_name, blob_name, destination_bucket_name, destination_blob_name, storage_client=None
 ):
-    """Copies a blob from one bucket to another with a new name."""
+    """Copies a blob from one bucket to another with a new name.
+    Skips the copy when the destination already exists with the same size.
+    Returns True when the blob was copied."""
     # bucket_name = "your-bucket-name"
     # blob_name = "your-object-name"
     # destination_bucket_name = "destination-bucket-name"
     # destination_blob_name = "destination-object-name"
-    from google.cloud import storage
-    storage_client = storage.Client()
+    if storage_client is None:
+        storage_client = get_client("storage")
 
     source_bucket = storage_client.bucket(bucket_name)
-    source_blob = source_bucket.blob(blob_name)
+    source_blob = source_bucket.get_blob(blob_name)
+    if source_blob is None:
+        raise ValueError(f"gs://{bucket_name}/{blob_name} does not exist")
     destination_bucket = storage_client.bucket(destination_bucket_name)
 
+    existing_blob = destination_bucket.get_blob(destination_blob_name)
+    if existing_blob is not None and existing_blob.size == source_blob.size:
+        print(f"File gs://{destination_bucket_name}/{destination_blob_name} already exists, skipped")
+        return False
+
     blob_copy = source_bucket.copy_blob(
         source_blob, destination_bucket, destination_blob_name
     )
@@ -71,49 +199,53 @@ def copy_blob(
         blob_copy.make_public()
     
     print(f"File copied from gs://{source_bucket.name}/{source_blob.name} \n\t\t to gs://{destination_bucket.name}/{blob_copy.name}")
+    return True
 
 
-def get_batch_data_gcs(BUCKET_NAME):
-    '''
-    Copy necessary files for datagen streaming
-    '''
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/hacked_customers_history.txt",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/hacked_customers_history.txt"
-    )
+def copy_blobs(copies: List[Tuple[str, str, str, str]], storage_client=None, max_workers: int = 8) -> int:
+    """Runs independent copy_blob calls concurrently.
+    Input: (bucket_name, blob_name, destination_bucket_name, destination_blob_name) tuples
+    Returns the number of blobs copied"""
+    if storage_client is None:
+        storage_client = get_client("storage")
 
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/hacked_terminals_history.txt",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/hacked_terminals_history.txt"
-    )
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/demographics/customer_profiles.csv",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/demographics/customer_profiles.csv"
-    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(copy_blob, *copy, storage_client=storage_client) for copy in copies]
+        return sum(future.result() for future in futures)
 
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/demographics/terminal_profiles.csv",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/demographics/terminal_profiles.csv"
-    )
 
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/demographics/customer_with_terminal_profiles.csv",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/demographics/customer_with_terminal_profiles.csv"
+def table_is_copied(bq_client, table_id: str, source_table_id: str) -> bool:
+    """True when table_id exists with as many rows as source_table_id."""
+    try:
+        table = bq_client.get_table(table_id)
+    except NotFound:
+        return False
+    return table.num_rows == bq_client.get_table(source_table_id).num_rows
+
+
+def run_ddl(statements: List[str], bq_client) -> None:
+    """
+    Input: DDL statements to execute in BigQuery
+    Submits all statements at once and waits for them together, without
+    downloading any result
+    """
+    jobs = [bq_client.query(sql) for sql in statements]
+    for job in jobs:
+        job.result()
+
+
+def get_batch_data_gcs(BUCKET_NAME, storage_client=None):
+    '''
+    Copy necessary files for datagen streaming
+    '''
+    copy_blobs(
+        [(SOURCE_BUCKET, blob_name, BUCKET_NAME, blob_name) for blob_name in DATAGEN_BLOBS],
+        storage_client=storage_client,
     )
 
     return "Done get_batch_data_gcs"
 
-def get_batch_data_bq(PROJECT):
+def get_batch_data_bq(PROJECT, bq_client=None):
 
     '''
     Creates the following tables in your project by copying from public tables:
@@ -126,75 +258,29 @@ def get_batch_data_bq(PROJECT):
     |-`customers` (table: profiles of customers)
     |-`terminals` (table: profiles of terminals)
     |-`customersterminals` (table: profiles of customers and terminals within their radius)
+
+    Tables that already exist with the row count of their source are skipped,
+    the others are created concurrently.
     '''
-    
-    run_bq_query(f"CREATE SCHEMA IF NOT EXISTS `{PROJECT}`.tx OPTIONS(location='us-central1');")
-    run_bq_query(f"CREATE SCHEMA IF NOT EXISTS `{PROJECT}`.demographics OPTIONS(location='us-central1');")
-    
-    #run_bq_query("CREATE SCHEMA IF NOT EXISTS `%s`.tx OPTIONS(location='%s');" % (PROJECT, 'us-central1'))
-    #run_bq_query("CREATE SCHEMA IF NOT EXISTS `%s`.demographics OPTIONS(location='%s');" % (PROJECT, 'us-central1'))
-    
-    run_bq_query(f"""
-    CREATE OR REPLACE TABLE `{PROJECT}`.tx.tx 
-    PARTITION BY
-    DATE(TX_TS)
-    AS (
-        SELECT
-        TX_ID,
-        TX_TS,
-        CUSTOMER_ID,
-        TERMINAL_ID,
-        TX_AMOUNT
-        FROM
-        `cymbal-fraudfinder`.txbackup.all
-    );
-    """)
-    print(f"BigQuery table created: `{PROJECT}`.tx.tx")
+    if bq_client is None:
+        bq_client = get_client("bigquery")
 
-    run_bq_query(f"""
-    CREATE OR REPLACE TABLE `{PROJECT}`.tx.txlabels
-    AS (
-        SELECT
-        TX_ID,
-        TX_FRAUD
-        FROM
-        `cymbal-fraudfinder`.txbackup.all
-    );
-    """)
-    print(f"BigQuery table created: `{PROJECT}`.tx.txlabels")
-    
-    run_bq_query(f"""
-    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.customers
-    AS (
-        SELECT
-        *
-        FROM
-        `cymbal-fraudfinder`.demographics.customers
-    );
-    """)
-    print(f"BigQuery table created: `{PROJECT}`.demographics.customers")
-    
-    run_bq_query(f"""
-    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.terminals
-    AS (
-        SELECT
-        *
-        FROM
-        `cymbal-fraudfinder`.demographics.terminals
-    );
-    """)
-    print(f"BigQuery table created: `{PROJECT}`.demographics.terminals")
-    
-    run_bq_query(f"""
-    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.customersterminals
-    AS (
-        SELECT
-        *
-        FROM
-        `cymbal-fraudfinder`.demographics.customersterminals
-    );
-    """)
-    print(f"BigQuery table created: `{PROJECT}`.demographics.customersterminals")
+    run_ddl(
+        [f"CREATE SCHEMA IF NOT EXISTS `{PROJECT}`.{dataset} OPTIONS(location='{BQ_LOCATION}');"
+         for dataset in BQ_DATASETS],
+        bq_client,
+    )
+
+    tables = []
+    for table, source_table, sql in BQ_TABLES:
+        if table_is_copied(bq_client, f"{PROJECT}.{table}", source_table):
+            print(f"BigQuery table already exists: `{PROJECT}`.{table}, skipped")
+        else:
+            tables.append((table, sql.format(PROJECT=PROJECT)))
+
+    run_ddl([sql for _, sql in tables], bq_client)
+    for table, _ in tables:
+        print(f"BigQuery table created: `{PROJECT}`.{table}")
     
     return "Done get_batch_data_bq"
 
@@ -0,0 +1,179 @@
+# Offline engine reproducing the customer and terminal features served by Vertex AI Feature Store:
+# the batch aggregates of 02_feature_engineering_batch.ipynb and the real-time aggregates of the
+# streaming pipeline. Used to backfill training data and to check the values of the Feature Store.
+
+import sys
+import os
+from typing import Dict, Tuple
+import numpy as np
+import pandas as pd
+
+# Windows of the batch features computed in BigQuery (02_feature_engineering_batch.ipynb), in seconds
+BATCH_WINDOWS = {"1day": 86400, "7day": 604800, "14day": 1209600}
+# Windows of the real-time features computed by the streaming pipeline, in seconds
+STREAM_WINDOWS = {"15min": 900, "30min": 1800, "60min": 3600}
+# Fraud labels only become known after this delay, so terminal risk skips the most recent week
+DELAY_PERIOD = 604800
+# Added to the denominator of the risk index, as in the BigQuery query
+RISK_EPSILON = 0.0001
+
+
+class RollingWindows:
+    '''
+    Trailing time windows over the transactions of each entity, evaluated for every transaction
+    at once. Transactions are sorted by (entity, time) and each window sum is the difference
+    of two cumulative sums, located with a binary search, so the cost is O(n log n) whatever
+    the window length.
+
+    A window of `w` seconds ending `lag` seconds before a transaction at `t` covers the
+    transactions of the same entity with a time in [t - lag - w, t - lag], bounds included
+    (and ties included), matching `RANGE BETWEEN w PRECEDING AND CURRENT ROW` in BigQuery.
+    '''
+
+    def __init__(self, entity_ids: np.ndarray, seconds: np.ndarray, max_window: int):
+        codes, _ = pd.factorize(entity_ids, sort=False)
+        self.order = np.lexsort((seconds, codes))
+        seconds = seconds - seconds.min()
+        # one key per transaction: entities are laid out far enough apart that no window spans two of them
+        stride = int(seconds.max()) + max_window + 1
+        self.keys = codes[self.order].astype(np.int64) * stride + seconds[self.order]
+
+    def cumsum(self, values: np.ndarray) -> np.ndarray:
+        '''
+        Cumulative sum of `values` in window order, with a leading 0
+        '''
+        return np.concatenate([[0], np.cumsum(values[self.order], dtype=np.float64)])
+
+    def bounds(self, window: int, lag: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        end = self.keys - lag
+        left = np.searchsorted(self.keys, end - window, side="left")
+        right = np.searchsorted(self.keys, end, side="right")
+        return left, right
+
+    def total(self, cumsum: np.ndarray, window: int, lag: int = 0) -> np.ndarray:
+        '''
+        Sum of the values of each transaction's window, in the original transaction order
+        '''
+        left, right = self.bounds(window, lag)
+        totals = np.empty(len(self.order), dtype=np.float64)
+        totals[self.order] = cumsum[right] - cumsum[left]
+        return totals
+
+
+def join_labels(tx: pd.DataFrame, labels: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Left joins the fraud labels of `tx.txlabels` to the transactions of `tx.tx`
+    '''
+    return tx.merge(labels[["TX_ID", "TX_FRAUD"]], on="TX_ID", how="left")
+
+
+def _window_inputs(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    amount = df["TX_AMOUNT"].to_numpy(dtype=np.float64, na_value=np.nan)
+    fraud = df["TX_FRAUD"].to_numpy(dtype=np.float64, na_value=np.nan)
+    return {
+        "tx": np.ones(len(df)),
+        "amount": np.nan_to_num(amount),
+        "has_amount": ~np.isnan(amount),
+        "fraud": np.nan_to_num(fraud),
+        # COUNT(TX_FRAUD) only counts labeled transactions
+        "labeled": ~np.isnan(fraud),
+    }
+
+
+def _average(total: np.ndarray, count: np.ndarray) -> np.ndarray:
+    return np.divide(total, count, out=np.full(len(total), np.nan), where=count > 0)
+
+
+def _seconds(ts: pd.Series) -> np.ndarray:
+    # BigQuery exports and parsed strings come back in microseconds, so the unit is not assumed
+    return pd.to_datetime(ts, utc=True).dt.floor("s").dt.as_unit("s").astype("int64").to_numpy()
+
+
+def _feature_ts(ts: pd.Series) -> pd.Series:
+    return pd.to_datetime(ts, utc=True).dt.floor("s")
+
+
+def customer_features(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Computes the customer features of every transaction: the labeled transaction counts and
+    average amounts over the batch windows, and the transaction counts and average amounts
+    over the real-time windows
+    '''
+    seconds = _seconds(df["TX_TS"])
+    windows = RollingWindows(df["CUSTOMER_ID"].to_numpy(), seconds, max(BATCH_WINDOWS.values()))
+    sums = {name: windows.cumsum(values) for name, values in _window_inputs(df).items()}
+
+    features = {"feature_ts": _feature_ts(df["TX_TS"]).to_numpy(), "customer_id": df["CUSTOMER_ID"].to_numpy()}
+    for name, window in BATCH_WINDOWS.items():
+        features[f"customer_id_nb_tx_{name}_window"] = windows.total(sums["labeled"], window).astype(np.int64)
+    for name, window in BATCH_WINDOWS.items():
+        features[f"customer_id_avg_amount_{name}_window"] = _average(
+            windows.total(sums["amount"], window), windows.total(sums["has_amount"], window))
+    for name, window in STREAM_WINDOWS.items():
+        features[f"customer_id_nb_tx_{name}_window"] = windows.total(sums["tx"], window).astype(np.int64)
+        features[f"customer_id_avg_amount_{name}_window"] = _average(
+            windows.total(sums["amount"], window), windows.total(sums["has_amount"], window))
+    return pd.DataFrame(features, index=df.index)
+
+
+def terminal_features(df: pd.DataFrame, delay: int = DELAY_PERIOD) -> pd.DataFrame:
+    '''
+    Computes the terminal features of every transaction: the labeled transaction counts and
+    risk indexes (share of frauds) over the batch windows ending `delay` seconds before the
+    transaction, and the transaction counts and average amounts over the real-time windows
+    '''
+    seconds = _seconds(df["TX_TS"])
+    windows = RollingWindows(df["TERMINAL_ID"].to_numpy(), seconds, max(BATCH_WINDOWS.values()) + delay)
+    sums = {name: windows.cumsum(values) for name, values in _window_inputs(df).items()}
+
+    # SUM(TX_FRAUD) is NULL over the delay period when it has no labeled transaction,
+    # which makes every risk index NULL in the BigQuery query
+    no_labels = windows.total(sums["labeled"], delay) == 0
+
+    features = {"feature_ts": _feature_ts(df["TX_TS"]).to_numpy(), "terminal_id": df["TERMINAL_ID"].to_numpy()}
+    risks = {}
+    for name, window in BATCH_WINDOWS.items():
+        # window shifted back by the delay period: [t - delay - window, t - delay)
+        nb_tx = windows.total(sums["labeled"], window + delay) - windows.total(sums["labeled"], delay)
+        nb_fraud = windows.total(sums["fraud"], window + delay) - windows.total(sums["fraud"], delay)
+        risks[name] = np.where(no_labels, np.nan, nb_fraud / (nb_tx + RISK_EPSILON))
+        features[f"terminal_id_nb_tx_{name}_window"] = nb_tx.astype(np.int64)
+    for name in BATCH_WINDOWS:
+        features[f"terminal_id_risk_{name}_window"] = risks[name]
+    for name, window in STREAM_WINDOWS.items():
+        features[f"terminal_id_nb_tx_{name}_window"] = windows.total(sums["tx"], window).astype(np.int64)
+        features[f"terminal_id_avg_amount_{name}_window"] = _average(
+            windows.total(sums["amount"], window), windows.total(sums["has_amount"], window))
+    return pd.DataFrame(features, index=df.index)
+
+
+def latest_features(features: pd.DataFrame, entity_column: str, as_of=None) -> pd.DataFrame:
+    '''
+    Keeps the most recent feature values of each entity (at or before `as_of` when given),
+    which is what the Feature Store serves online
+    '''
+    if as_of is not None:
+        features = features[features["feature_ts"] <= pd.Timestamp(as_of, tz="UTC")]
+    return (features.sort_values("feature_ts", kind="stable")
+            .drop_duplicates(entity_column, keep="last")
+            .set_index(entity_column))
+
+
+def read_table(path: str) -> pd.DataFrame:
+    if path.endswith(".parquet") or os.path.isdir(path):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+if __name__ == "__main__":
+    # Backfills the customer and terminal features from local exports of tx.tx and tx.txlabels:
+    #   python feature_engine.py tx.parquet txlabels.parquet output_dir
+    TX_PATH, LABELS_PATH, OUTPUT_DIR = sys.argv[1:4]
+    transactions = join_labels(read_table(TX_PATH), read_table(LABELS_PATH))
+    print(f"{len(transactions)} transactions loaded")
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    customer_features(transactions).to_parquet(os.path.join(OUTPUT_DIR, "customer_features.parquet"), index=False)
+    print(f"Customer features saved to {OUTPUT_DIR}/customer_features.parquet")
+    terminal_features(transactions).to_parquet(os.path.join(OUTPUT_DIR, "terminal_features.parquet"), index=False)
+    print(f"Terminal features saved to {OUTPUT_DIR}/terminal_features.parquet")
@@ -7,13 +7,21 @@
 # General
 import os
 import sys
-from typing import Union, List
+from typing import Iterable, Union, List
 import random
 from datetime import datetime, timedelta
 import time
 import json
+import io
+import re
+import base64
+import hashlib
+import tempfile
+import contextlib
 import logging
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 
 # GCP 
 from google.cloud import aiplatform as vertex_ai
@@ -23,6 +31,9 @@ import google.cloud.storage as storage
 # Data Preprocessing
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 # Model Training
 from google.cloud import bigquery
@@ -32,6 +43,9 @@ from sklearn.metrics import f1_score
 from sklearn.linear_model import LogisticRegression
 import xgboost as xgb
 
+# Shared clients
+from utils import get_bigquery_client, get_storage_client
+
 # Define constants and variables 
 
 # General
@@ -50,6 +64,24 @@ COLUMNS_IGNORE = [
 ]
 TARGET = "tx_fraud"
 
+# BigQuery
+BQ_DRY_RUN = os.environ.get("BQ_DRY_RUN", "false").lower() == "true"  # validate every query with a dry run first
+QUERY_CACHE_DIR = os.environ.get("QUERY_CACHE_DIR", os.path.expanduser("~/.cache/fraudfinder/bq"))  # "" disables it
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES", 2 * 1024**3))
+
+# Artifact transfers
+ARTIFACT_CHUNK_SIZE = int(os.environ.get("ARTIFACT_CHUNK_SIZE", 8 * 1024**2))  # multiple of 256 KiB
+ARTIFACT_PARALLEL_THRESHOLD = int(os.environ.get("ARTIFACT_PARALLEL_THRESHOLD", 64 * 1024**2))
+ARTIFACT_TRANSFER_WORKERS = int(os.environ.get("ARTIFACT_TRANSFER_WORKERS", 8))
+
+# Hyperparameter sweep
+SWEEP_MAX_WORKERS = int(os.environ.get("SWEEP_MAX_WORKERS", 0)) or None  # defaults to one candidate per core
+SWEEP_NUM_BOOST_ROUND = int(os.environ.get("SWEEP_NUM_BOOST_ROUND", 100))
+SWEEP_MODE = os.environ.get("SWEEP_MODE", "grid")  # "grid" or "halving"
+SWEEP_SEED = int(os.environ.get("SWEEP_SEED", 42))
+SWEEP_MIN_ROUNDS = int(os.environ.get("SWEEP_MIN_ROUNDS", 10))  # rounds of the first halving rung
+SWEEP_HALVING_FACTOR = int(os.environ.get("SWEEP_HALVING_FACTOR", 3))
+
 
 def load_environment_variables_from_gcs(bucket_name, file_path):
     """Loads environment variables from a Python file in GCS.
@@ -62,10 +94,7 @@ def load_environment_variables_from_gcs(bucket_name, file_path):
         None. Sets the environment variables directly.
     """
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_path)
-    config_file_content = blob.download_as_string().decode("utf-8")
+    config_file_content = download_artifact(bucket_name, file_path).decode("utf-8")
 
     # Execute the content of the config file in a local dictionary
     local_vars = {}
@@ -92,69 +121,582 @@ def get_gcp_project():
     print("gcloud CLI not found. Please install and configure it.")
     return None
 
+def _crc32c(source: Union[str, bytes]) -> str:
+    """base64 CRC32C of a file or a buffer, in the format of Blob.crc32c"""
+    import google_crc32c
+
+    checksum = google_crc32c.Checksum()
+    if isinstance(source, (bytes, bytearray)):
+        checksum.update(bytes(source))
+    else:
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(ARTIFACT_CHUNK_SIZE), b""):
+                checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+def upload_artifact(source: Union[str, bytes], bucket_name: str, blob_name: str, content_type: str = None) -> bool:
+    """Uploads a file or an in-memory buffer to GCS, unless the same content is already there.
+
+    Uploads are resumable and sent in ARTIFACT_CHUNK_SIZE chunks, so that a failed
+    chunk is retried on its own. Artifacts larger than ARTIFACT_PARALLEL_THRESHOLD are
+    uploaded as parts in parallel and assembled by GCS.
+
+    Args:
+        source: local file path or bytes to upload
+        bucket_name: The name of the GCS bucket.
+        blob_name: The path of the artifact within the bucket.
+        content_type: content type of the artifact
+
+    Returns:
+        True when the artifact was uploaded, False when an identical one already existed
+    """
+    from google.cloud.storage import transfer_manager
+
+    bucket = get_storage_client().bucket(bucket_name)
+    crc32c = _crc32c(source)
+    existing = bucket.get_blob(blob_name)
+    if existing is not None and existing.crc32c == crc32c:
+        print(f"gs://{bucket_name}/{blob_name} is up to date, upload skipped")
+        return False
+
+    blob = bucket.blob(blob_name, chunk_size=ARTIFACT_CHUNK_SIZE)
+    size = len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+    if size <= ARTIFACT_PARALLEL_THRESHOLD:
+        if isinstance(source, (bytes, bytearray)):
+            blob.upload_from_file(io.BytesIO(source), size=size, content_type=content_type, checksum="crc32c")
+        else:
+            blob.upload_from_filename(source, content_type=content_type, checksum="crc32c")
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            if isinstance(source, (bytes, bytearray)):
+                path = os.path.join(temp_dir, os.path.basename(blob_name))
+                with open(path, "wb") as f:
+                    f.write(source)
+                source = path
+            transfer_manager.upload_chunks_concurrently(
+                source, blob, content_type=content_type, chunk_size=ARTIFACT_CHUNK_SIZE,
+                max_workers=ARTIFACT_TRANSFER_WORKERS, worker_type=transfer_manager.THREAD,
+            )
+    print(f"Uploaded gs://{bucket_name}/{blob_name} ({size} bytes)")
+    return True
+
+
+def download_artifact(bucket_name: str, blob_name: str, destination: str = None) -> Union[bytes, str]:
+    """Downloads an artifact from GCS in ARTIFACT_CHUNK_SIZE chunks.
+
+    Args:
+        bucket_name: The name of the GCS bucket.
+        blob_name: The path of the artifact within the bucket.
+        destination: local file to write to; the content is returned as bytes when omitted
+
+    Returns:
+        the content, or the destination path
+    """
+    from google.cloud.storage import transfer_manager
+
+    blob = get_storage_client().bucket(bucket_name).get_blob(blob_name)
+    if blob is None:
+        raise FileNotFoundError(f"gs://{bucket_name}/{blob_name} does not exist")
+    blob.chunk_size = ARTIFACT_CHUNK_SIZE
+    if destination is None:
+        return blob.download_as_bytes(checksum="crc32c")
+    if blob.size > ARTIFACT_PARALLEL_THRESHOLD:
+        transfer_manager.download_chunks_concurrently(
+            blob, destination, chunk_size=ARTIFACT_CHUNK_SIZE,
+            max_workers=ARTIFACT_TRANSFER_WORKERS, worker_type=transfer_manager.THREAD,
+        )
+    else:
+        blob.download_to_filename(destination, checksum="crc32c")
+    return destination
+
+
 def save_model_to_gcs(model, bucket_name, model_path):
     """Saves a model to a GCS bucket.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(model_path)
-
-    # Save the model to a temporary file
-    temp_file = "/tmp/model.bst" 
-    model.save_model(temp_file)
+    # Save the model to a temporary file private to this process
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_file = os.path.join(temp_dir, os.path.basename(model_path))
+        model.save_model(temp_file)
 
-    # Upload the temporary file to GCS
-    blob.upload_from_filename(temp_file)
+        # Upload the temporary file to GCS
+        upload_artifact(temp_file, bucket_name, model_path)
 
     
-def run_bq_query(sql: str) -> Union[str, pd.DataFrame]:
+class QueryCache:
+    """On-disk cache of BigQuery query results, stored as Parquet.
+
+    Entries are keyed by the normalized SQL and by the project and location of the client,
+    which resolve unqualified table names (`tx.tx`). Each entry records the last-modified time of
+    the tables the query referenced, and is only served while none of them has changed;
+    a result is not stored when a table changed after the query started, and queries
+    calling non-deterministic functions are never cached.
+    The least recently used entries are evicted once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(sql: str, project: str = None, location: str = None) -> str:
+        normalized = re.sub(r"\s+", " ", sql).strip().rstrip(";").strip()
+        return hashlib.sha256(f"{project}\n{location}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def _paths(self, sql: str, bq_client):
+        key = self.key(sql, bq_client.project, bq_client.location)
+        return os.path.join(self.cache_dir, f"{key}.parquet"), os.path.join(self.cache_dir, f"{key}.json")
+
+    # functions making a result differ between runs, which BigQuery does not cache either
+    NON_DETERMINISTIC = re.compile(
+        r"\b(CURRENT_(DATE|TIME|TIMESTAMP|DATETIME)|RAND|GENERATE_UUID|SESSION_USER)\b", re.IGNORECASE)
+
+    @classmethod
+    def cacheable(cls, sql: str) -> bool:
+        return cls.NON_DETERMINISTIC.search(sql) is None
+
+    @staticmethod
+    def _modified(bq_client, table_ids: List[str]) -> dict:
+        return {table_id: bq_client.get_table(table_id).modified for table_id in table_ids}
+
+    def get(self, sql: str, bq_client) -> Union[pd.DataFrame, None]:
+        data_path, meta_path = self._paths(sql, bq_client)
+        if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path) as f:
+            tables = json.load(f)["tables"]
+        modified = self._modified(bq_client, list(tables))
+        if {table_id: time.isoformat() for table_id, time in modified.items()} != tables:
+            return None
+        os.utime(data_path)  # mark as recently used
+        return pq.read_table(data_path).to_pandas()
+
+    def put(self, sql: str, table: pa.Table, bq_client, referenced_tables: List[str], started: datetime) -> bool:
+        # a table modified after the job started may not match the rows read, so the
+        # result is not cached rather than recorded against the newer version
+        modified = self._modified(bq_client, referenced_tables)
+        if any(time > started for time in modified.values()):
+            return False
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data_path, meta_path = self._paths(sql, bq_client)
+        # write to temporary files and rename them, so a crash never leaves a partial entry;
+        # the metadata goes last since get() needs both files
+        pq.write_table(table, data_path + ".tmp")
+        os.replace(data_path + ".tmp", data_path)
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump({"sql": sql, "tables": {table_id: time.isoformat() for table_id, time in modified.items()}}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        self.evict()
+        return True
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".parquet"):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for entry_path in (path, path[:-len(".parquet")] + ".json"):
+                # the metadata may be missing after a crash, or another process may have evicted the entry
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(entry_path)
+            total -= size
+
+
+def run_bq_query(sql: str, dry_run: bool = BQ_DRY_RUN, use_cache: bool = True) -> Union[str, pd.DataFrame]:
     """
     Run a BigQuery query and return the job ID or result as a DataFrame
     Args:
         sql: SQL query, as a string, to execute in BigQuery
+        dry_run: validate the query with a dry run before running it
+        use_cache: serve SELECT results from the local query cache while their tables are unchanged,
+            except for queries calling non-deterministic functions (CURRENT_DATE(), RAND()...)
     Returns:
         df: DataFrame of results from query, or error, if any
     """
 
-    bq_client = bigquery.Client()
-
-    # Try dry run before executing query to catch any errors
-    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
-    bq_client.query(sql, job_config=job_config)
+    bq_client = get_bigquery_client()
+    cache = None
+    if use_cache and QUERY_CACHE_DIR and QueryCache.cacheable(sql):
+        cache = QueryCache(QUERY_CACHE_DIR, QUERY_CACHE_MAX_BYTES)
+    if cache is not None:
+        df = cache.get(sql, bq_client)
+        if df is not None:
+            print("Loaded from the local query cache")
+            return df
+
+    if dry_run:
+        # Try dry run before executing query to catch any errors
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        bq_client.query(sql, job_config=job_config)
 
-    # If dry run succeeds without errors, proceed to run query
     job_config = bigquery.QueryJobConfig()
     client_result = bq_client.query(sql, job_config=job_config)
 
     job_id = client_result.job_id
 
     # Wait for query/job to finish running. then get & return data frame
-    df = client_result.result().to_arrow().to_pandas()
+    table = client_result.result().to_arrow()
     print(f"Finished job_id: {job_id}")
-    return df
+
+    referenced_tables = [
+        f"{ref.project}.{ref.dataset_id}.{ref.table_id}" for ref in client_result.referenced_tables
+    ]
+    if cache is not None and client_result.statement_type == "SELECT" and referenced_tables:
+        cache.put(sql, table, bq_client, referenced_tables, client_result.started)
+    return table.to_pandas()
 
 
-def preprocess(df: pd.DataFrame):
+# Training data of a sweep worker process, set once by _init_sweep_worker
+_sweep_data = {}
+
+
+def _share_array(array: np.ndarray):
+    """Copies an array into a new shared memory block.
+
+    Returns:
+        the block, to close and unlink once the sweep is over, and the spec to attach to it
     """
-    Converts categorical features to numeric. Removes unused columns.
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach_array(spec):
+    """Maps an array shared with _share_array, without copying it.
+    """
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+
+
+def _init_sweep_worker(specs: dict, nthread: int):
+    """Maps the shared training and validation arrays and builds the training matrix once per worker process.
+
+    The raw arrays live once in shared memory for all the workers. Each worker only holds its
+    own QuantileDMatrix of the training data: about one byte per value, against eight for a
+    DMatrix, so a sweep needs roughly (4 + max_workers) bytes per training value. Validation
+    predictions run in place on the shared array.
+
+    Args:
+        specs: shared memory specs of x_train, y_train, x_val and y_val
+        nthread: number of threads each candidate trains with
+    """
+    arrays = {}
+    for name, spec in specs.items():
+        block, arrays[name] = _attach_array(spec)
+        # keep the mapping open as long as the worker lives
+        _sweep_data.setdefault("blocks", []).append(block)
+    _sweep_data["dtrain"] = xgb.QuantileDMatrix(arrays["x_train"], label=arrays["y_train"], nthread=nthread)
+    _sweep_data["x_val"] = arrays["x_val"]
+    _sweep_data["y_val"] = arrays["y_val"]
+    _sweep_data["nthread"] = nthread
+
+
+def train_candidate(index: int, run_name: str, params: dict, num_boost_round: int, model: bytes = None) -> dict:
+    """Trains and validates one sweep candidate in a worker process.
+
     Args:
-        df: Pandas df with raw data
+        index: position of the candidate in the grid
+        run_name: experiment run name of the candidate
+        params: XGBoost parameters of the candidate
+        num_boost_round: number of boosting rounds to add
+        model: serialized booster to continue boosting from, if any
+
     Returns:
-        df with preprocessed data
+        dict with the run name, parameters, validation metrics and the serialized booster
+    """
+    booster = xgb.train(
+        {"objective": "reg:logistic", "nthread": _sweep_data["nthread"], **params},
+        _sweep_data["dtrain"],
+        num_boost_round=num_boost_round,
+        xgb_model=bytearray(model) if model is not None else None,
+    )
+    y_val = _sweep_data["y_val"]
+    y_pred = (booster.inplace_predict(_sweep_data["x_val"]) > 0.5).astype(int)
+    return {
+        "index": index,
+        "run_name": run_name,
+        "params": params,
+        "rounds": booster.num_boosted_rounds(),
+        "metrics": {
+            "acc_score": accuracy_score(y_val, y_pred),
+            "f1score": f1_score(y_val, y_pred, average="weighted"),
+        },
+        "model": bytes(booster.save_raw()),
+    }
+
+
+def log_candidates(results: List[dict]):
+    """Logs the sweep candidates as Vertex AI Experiments runs, in one pass once the sweep is over.
+
+    Experiments has no call writing several runs at once, so each run still takes its own
+    requests, but none of them sits between the training of two candidates any more.
     """
-    df = df.drop(columns=UNUSED_COLUMNS)
+    for result in sorted(results, key=lambda result: result["index"]):
+        print(f"{result['run_name']} ({result['rounds']} rounds): {result['metrics']}")
+        vertex_ai.start_run(run=result["run_name"])
+        vertex_ai.log_params(dict(result["params"], num_boost_round=result["rounds"]))
+        vertex_ai.log_metrics(result["metrics"])
+        vertex_ai.end_run()
+
 
-    # Drop rows with NaN"s
-    df = df.dropna()
+def rank_candidates(results: List[dict]) -> List[dict]:
+    """Sorts candidates by decreasing validation F1, ties broken by grid position.
+    """
+    return sorted(results, key=lambda result: (-result["metrics"]["f1score"], result["index"]))
 
-    # Convert integer valued (numeric) columns to floating point
-    numeric_columns = df.select_dtypes(["int32", "float32", "float64"]).columns
-    df[numeric_columns] = df[numeric_columns].astype("float32")
 
-    dummy_columns = list(df.dtypes[df.dtypes == "category"].index)
-    df = pd.get_dummies(df, columns=dummy_columns)
+def run_sweep(parameters: List[dict], x_train, y_train, x_val, y_val, run_prefix: str,
+              max_workers: int = None, num_boost_round: int = 100, mode: str = "grid", seed: int = 42,
+              min_rounds: int = 10, halving_factor: int = 3) -> dict:
+    """Trains the candidates concurrently and returns the best one by validation F1.
+
+    The data is shared with the worker processes through shared memory (see _init_sweep_worker
+    for the memory cost of each worker), the candidates train with the hist tree method, and
+    the cores are split between the workers so that the candidates do not oversubscribe the host.
+
+    In "grid" mode every candidate is boosted for `num_boost_round` rounds. In "halving" mode (successive halving) every
+    candidate is first boosted for `min_rounds` rounds; only the top 1/`halving_factor`
+    by validation F1 survive each rung, and the survivors keep boosting from where they
+    stopped until the rung budget, multiplied by `halving_factor` each time, reaches
+    `num_boost_round`. Every candidate is logged to Vertex AI Experiments, with its last rung
+    in "halving" mode, once the sweep is over.
+
+    Args:
+        parameters: XGBoost parameters of each candidate
+        x_train, y_train: training features and labels
+        x_val, y_val: validation features and labels
+        run_prefix: prefix of the experiment run names
+        max_workers: number of candidates trained at once, defaults to the number of cores
+        num_boost_round: boosting rounds of each (surviving) candidate
+        mode: "grid" or "halving"
+        seed: XGBoost seed of every candidate, so that sweeps are reproducible
+        min_rounds: boosting rounds of the first halving rung
+        halving_factor: inverse of the fraction of candidates kept at each rung
+
+    Returns:
+        dict of the best candidate, with its booster loaded under "model"
+    """
+    if mode not in ("grid", "halving"):
+        raise ValueError(f"unknown sweep mode {mode}, expected grid or halving")
+    if mode == "halving" and (halving_factor < 2 or min_rounds < 1):
+        # the rung budget would never grow and the sweep would loop forever
+        raise ValueError(f"halving needs halving_factor >= 2 and min_rounds >= 1, "
+                         f"got {halving_factor} and {min_rounds}")
+    cpu_count = os.cpu_count() or 1
+    max_workers = min(max_workers or cpu_count, len(parameters))
+    nthread = max(1, cpu_count // max_workers)
+    candidates = [
+        {"index": i, "run_name": f"{run_prefix}-{i}", "params": {**params, "seed": seed}, "model": None}
+        for i, params in enumerate(parameters)
+    ]
+
+    blocks, specs = [], {}
+    for name, array in {"x_train": x_train, "y_train": y_train, "x_val": x_val, "y_val": y_val}.items():
+        block, specs[name] = _share_array(np.asarray(array))
+        blocks.append(block)
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_sweep_worker,
+            initargs=(specs, nthread),
+        ) as executor:
+            def train(candidates, rounds):
+                return [
+                    executor.submit(train_candidate, c["index"], c["run_name"], c["params"], rounds, c["model"])
+                    for c in candidates
+                ]
+
+            if mode == "grid":
+                results = [future.result() for future in as_completed(train(candidates, num_boost_round))]
+                logged = results
+            else:
+                logged = []
+                rounds, rung_budget = 0, min(min_rounds, num_boost_round)
+                while True:
+                    results = [future.result() for future in train(candidates, rung_budget - rounds)]
+                    rounds = rung_budget
+                    ranked = rank_candidates(results)
+                    if len(ranked) == 1 or rounds >= num_boost_round:
+                        break
+                    keep = max(1, len(ranked) // halving_factor)
+                    logged.extend(ranked[keep:])
+                    candidates = ranked[:keep]
+                    rung_budget = min(rung_budget * halving_factor, num_boost_round)
+                    print(f"halving: {keep} candidates continue to {rung_budget} rounds")
+                logged.extend(ranked)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    log_candidates(logged)
+    best = rank_candidates(results)[0]
+    model = xgb.Booster()
+    model.load_model(bytearray(best["model"]))
+    return dict(best, model=model)
+
+
+class Preprocessor:
+    """Preprocessing fitted on the training split and applied unchanged to the other splits.
+
+    Removes unused columns and rows with NaN's, and one-hot encodes the categorical
+    columns with the categories seen during fit, so that every split gets the same
+    columns in the same order. The fitted state is saved as JSON next to model.bst,
+    so that the inference service can rebuild the feature order.
+    """
+
+    def __init__(self, label_column: str, unused_columns: List[str]):
+        self.label_column = label_column
+        self.unused_columns = list(unused_columns)
+        self.categories = {}
+        self.feature_columns = []
+
+    def fit(self, df: pd.DataFrame) -> "Preprocessor":
+        """
+        Learns the categories of the categorical columns and the output column order.
+        Args:
+            df: Pandas df with the raw training data
+        Returns:
+            the fitted preprocessor
+        """
+        df = df.drop(columns=self.unused_columns + [self.label_column], errors="ignore")
+        self.categories = {
+            column: [str(category) for category in df[column].dropna().unique()]
+            for column in df.columns
+            if df[column].dtype == "category"
+        }
+        self.feature_columns = []
+        for column in df.columns:
+            if column in self.categories:
+                self.feature_columns.extend(f"{column}_{category}" for category in self.categories[column])
+            else:
+                self.feature_columns.append(column)
+        return self
+
+    def transform(self, df: pd.DataFrame):
+        """
+        Converts raw data to the fitted float32 feature matrix.
+        Args:
+            df: Pandas df with raw data
+        Returns:
+            x: float32 NumPy array with the columns of feature_columns
+            y: int labels, or None when df has no label column
+        """
+        df = df.drop(columns=self.unused_columns, errors="ignore")
+
+        # Drop rows with NaN"s
+        df = df.dropna()
+
+        for column, categories in self.categories.items():
+            df[column] = pd.Categorical(df[column].astype(str), categories=categories)
+        dummies = pd.get_dummies(df.drop(columns=[self.label_column], errors="ignore"),
+                                 columns=list(self.categories))
+        x = dummies.reindex(columns=self.feature_columns, fill_value=0).to_numpy(dtype=np.float32)
+        y = df[self.label_column].astype(int).to_numpy() if self.label_column in df else None
+        return x, y
+
+    def transform_batches(self, batches: Iterable[pa.RecordBatch], num_rows: int = None):
+        """
+        Builds the fitted float32 feature matrix directly from Arrow record batches,
+        without an intermediate Pandas df. As in transform, rows with a null or NaN in any
+        column other than the unused ones are dropped, categorical and label columns included.
+        Not used by the __main__ flow below, whose data comes from batch_serve_to_df as a
+        Pandas df; it is meant for data already in BigQuery or Parquet (see load_bq_matrix).
+        Args:
+            batches: Arrow record batches with the raw columns, e.g. from BigQuery or a Parquet file
+            num_rows: total number of rows when known, to allocate the matrix once
+        Returns:
+            x: float32 NumPy array with the columns of feature_columns
+            y: int labels, or None when the batches have no label column
+        """
+        sources = {
+            f"{column}_{category}": (column, category)
+            for column, categories in self.categories.items()
+            for category in categories
+        }
+        x = np.empty((num_rows or 0, len(self.feature_columns)), dtype=np.float32)
+        y = np.empty(num_rows or 0, dtype=np.int64)
+        has_label = None
+        n = 0
+        for batch in batches:
+            if has_label is None:
+                has_label = self.label_column in batch.schema.names
+            rows = batch.num_rows
+            if n + rows > len(x):
+                # grow geometrically when the total is unknown
+                capacity = max(2 * len(x), n + rows)
+                x = np.resize(x, (capacity, x.shape[1]))
+                y = np.resize(y, capacity)
+            block = x[n:n + rows]
+            for j, name in enumerate(self.feature_columns):
+                column, category = sources.get(name, (name, None))
+                values = batch.column(column)
+                if category is not None:
+                    values = pc.fill_null(pc.equal(values.cast(pa.string()), category), False)
+                block[:, j] = values.to_numpy(zero_copy_only=False)
+
+            # Drop rows with NaN"s in any used column, compacting the block in place
+            keep = np.ones(rows, dtype=bool)
+            for column in batch.schema.names:
+                if column not in self.unused_columns:
+                    keep &= ~pc.is_null(batch.column(column), nan_is_null=True).to_numpy(zero_copy_only=False)
+            if has_label:
+                labels = pc.fill_null(batch.column(self.label_column), 0).to_numpy(zero_copy_only=False)
+            kept = int(keep.sum())
+            if kept < rows:
+                block[:kept] = block[keep]
+            if has_label:
+                y[n:n + kept] = labels[keep]
+            n += kept
+        return x[:n], (y[:n] if has_label else None)
+
+    def to_dict(self) -> dict:
+        return {
+            "label_column": self.label_column,
+            "unused_columns": self.unused_columns,
+            "categories": self.categories,
+            "feature_columns": self.feature_columns,
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "Preprocessor":
+        preprocessor = cls(state["label_column"], state["unused_columns"])
+        preprocessor.categories = state["categories"]
+        preprocessor.feature_columns = state["feature_columns"]
+        return preprocessor
+
+
+def load_bq_matrix(sql: str, preprocessor: Preprocessor, bq_client: bigquery.Client = None):
+    """
+    Runs a BigQuery query and streams its result as Arrow record batches straight
+    into the float32 feature matrix of a fitted preprocessor. The same rows are kept as
+    with preprocessor.transform(run_bq_query(sql)), without the intermediate Pandas df.
+    Args:
+        sql: SQL query, as a string, to execute in BigQuery
+        preprocessor: fitted Preprocessor
+        bq_client: BigQuery client, the shared one by default
+    Returns:
+        x, y: float32 features and int labels
+    """
+    bq_client = bq_client or get_bigquery_client()
+    rows = bq_client.query(sql).result()
+    return preprocessor.transform_batches(rows.to_arrow_iterable(), num_rows=rows.total_rows)
+
+
+def save_preprocessor_to_gcs(preprocessor: Preprocessor, bucket_name: str, path: str):
+    """Saves the fitted preprocessor as JSON to a GCS bucket.
+    """
+    upload_artifact(json.dumps(preprocessor.to_dict(), indent=2).encode("utf-8"), bucket_name, path,
+                    content_type="application/json")
 
-    return df
 
 if __name__ == "__main__": 
     
@@ -190,7 +732,7 @@ if __name__ == "__main__":
     EXPERIMENT_NAME = f"ff-experiment-{ID}"
     
     
-    bq_client = bigquery.Client(project=PROJECT_ID, location=REGION)
+    bq_client = get_bigquery_client(project=PROJECT_ID, location=REGION)
 
     vertex_ai.init(
         project=PROJECT_ID,
@@ -252,26 +794,11 @@ if __name__ == "__main__":
         [int(0.6 * len(df_dataset)), int(0.8 * len(df_dataset))],
     )
 
-    # Training set
-    preprocessed_train_data = preprocess(df_train)
-    x_train = preprocessed_train_data[
-        preprocessed_train_data.columns.drop(LABEL_COLUMN).to_list()
-    ].values
-    y_train = preprocessed_train_data.loc[:, LABEL_COLUMN].astype(int)
-
-    # Validation set
-    preprocessed_val_data = preprocess(df_val)
-    x_val = preprocessed_val_data[
-        preprocessed_val_data.columns.drop(LABEL_COLUMN).to_list()
-    ].values
-    y_val = preprocessed_val_data.loc[:, LABEL_COLUMN].astype(int)
-
-    # Test set
-    preprocessed_test_data = preprocess(df_test)
-    x_test = preprocessed_test_data[
-        preprocessed_test_data.columns.drop(LABEL_COLUMN).to_list()
-    ].values
-    y_test = preprocessed_test_data.loc[:, LABEL_COLUMN].astype(int)
+    # Fit the preprocessing on the training set only and apply it to every split
+    preprocessor = Preprocessor(LABEL_COLUMN, UNUSED_COLUMNS).fit(df_train)
+    x_train, y_train = preprocessor.transform(df_train)
+    x_val, y_val = preprocessor.transform(df_val)
+    x_test, y_test = preprocessor.transform(df_test)
 
 
     parameters = [
@@ -285,27 +812,17 @@ if __name__ == "__main__":
         {"eta": 0.3, "gamma": 0.1, "max_depth": 5},
     ]
 
-    models = {}
-    for i, params in enumerate(parameters):
-        run_name = f"ff-xgboost-local-run-app-{i}"
-        print(run_name)
-        vertex_ai.start_run(run=run_name)
-        vertex_ai.log_params(params)
-        model = xgb.XGBClassifier(
-            objective="reg:logistic",
-            max_depth=params["max_depth"],
-            gamma=params["gamma"],
-            eta=params["eta"],
-            use_label_encoder=False,
-        )
-        model.fit(x_train, y_train)
-        models[run_name] = model
-        y_pred_proba = model.predict_proba(x_val)[:, 1]
-        y_pred = model.predict(x_val)
-        acc_score = accuracy_score(y_val, y_pred)
-        val_f1_score = f1_score(y_val, y_pred, average="weighted")
-        vertex_ai.log_metrics({"acc_score": acc_score, "f1score": val_f1_score})
-        vertex_ai.end_run()
+    best = run_sweep(
+        parameters, x_train, y_train, x_val, y_val,
+        run_prefix="ff-xgboost-local-run-app",
+        max_workers=SWEEP_MAX_WORKERS,
+        num_boost_round=SWEEP_NUM_BOOST_ROUND,
+        mode=SWEEP_MODE,
+        seed=SWEEP_SEED,
+        min_rounds=SWEEP_MIN_ROUNDS,
+        halving_factor=SWEEP_HALVING_FACTOR,
+    )
+    print(f"best candidate: {best['run_name']} {best['params']} {best['metrics']}")
 
 
     experiment_df = vertex_ai.get_experiment_df()
@@ -314,10 +831,11 @@ if __name__ == "__main__":
     model_directory = "models"  # Changed to current directory
     os.makedirs(model_directory, exist_ok=True)  # Create if it doesn't exist
 
-    model = models[f"ff-xgboost-local-run-app-{i}"]
+    model = best["model"]
     artifact_filename = "model.bst"
     # Replace with your desired bucket name and model path
     bucket_name = "model-upload"  
     model_path = "models/model.bst"  
 
-    save_model_to_gcs(model, bucket_name, model_path) 
+    save_model_to_gcs(model, bucket_name, model_path)
+    save_preprocessor_to_gcs(preprocessor, bucket_name, f"{os.path.dirname(model_path)}/preprocessor.json")
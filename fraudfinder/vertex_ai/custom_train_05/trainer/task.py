@@ -1,12 +1,12 @@
 import os
 import json
+import shutil
 import yaml
 from pathlib import Path
-import dask.dataframe as dask_df
-from dask.distributed import LocalCluster, Client
 import xgboost as xgb
 from trainer.utils import (
-    gcs_path_to_local_path, resample, preprocess, evaluate_model, gcs_read, 
+    gcs_path_to_local_path, stratified_sample, load_preprocessed, evaluate_model, gcs_read,
+    dask_client, run_dask_worker, cluster_spec, is_chief, chief_scheduler_address, latest_checkpoint,
     VertexConfig
 )
 
@@ -23,6 +23,7 @@ TRAINING_DATA_PATH = gcs_path_to_local_path(os.environ["AIP_TRAINING_DATA_URI"])
 TEST_DATA_PATH = gcs_path_to_local_path(os.environ["AIP_TEST_DATA_URI"])
 MODEL_DIR = gcs_path_to_local_path(os.environ["AIP_MODEL_DIR"])
 MODEL_PATH = MODEL_DIR + "model.bst"
+CHECKPOINT_DIR = MODEL_DIR + "checkpoints"
 
 
 # Training variables
@@ -32,51 +33,125 @@ def main():
     deliverable_uri = (Path(bucket)/"deliverables")
     metrics_uri = (deliverable_uri/"metrics.json")
 
-    # read data
-    train_df = dask_df.read_csv(TRAINING_DATA_PATH, dtype=vertex_config.DATA_SCHEMA)
-    test_df = dask_df.read_csv(TEST_DATA_PATH, dtype=vertex_config.DATA_SCHEMA)
-    print("df loaded")
-    
-    # preprocessing
-    preprocessed_train_df = preprocess(train_df, vertex_config.DROP_COLUMNS)
-    preprocessed_test_df = preprocess(test_df, vertex_config.DROP_COLUMNS)
-    print("df preprocessed")
-
-    # downsampling
-    train_nfraud_df = preprocessed_train_df[preprocessed_train_df[vertex_config.TARGET_COLUMN]==0]
-    train_fraud_df = preprocessed_train_df[preprocessed_train_df[vertex_config.TARGET_COLUMN]==1]
-    train_nfraud_downsample = resample(train_nfraud_df, replace=True, frac=len(train_fraud_df)/len(train_df))
-    ds_preprocessed_train_df = dask_df.concat([train_nfraud_downsample, train_fraud_df])
+    cache_dir = None
+    if vertex_config.DATA_CACHE_ENABLED:
+        cache_dir = (gcs_path_to_local_path(vertex_config.DATA_CACHE_URI) if vertex_config.DATA_CACHE_URI
+                     else str(deliverable_uri/"preprocessed"))
+
+    # with several replicas, the other ones join this cluster as workers (see worker_main)
+    remote_workers = vertex_config.REPLICA_COUNT - 1
+    scheduler_port = None
+    if remote_workers and not vertex_config.DASK_SCHEDULER_ADDRESS:
+        scheduler_port = vertex_config.DASK_SCHEDULER_PORT
+
+    # start the cluster first, so that reading and preprocessing also run on the workers
+    with dask_client(
+        scheduler_address=vertex_config.DASK_SCHEDULER_ADDRESS,
+        n_workers=vertex_config.DASK_N_WORKERS,
+        threads_per_worker=vertex_config.DASK_THREADS_PER_WORKER,
+        memory_limit=vertex_config.DASK_MEMORY_LIMIT,
+        spill_dir=vertex_config.DASK_SPILL_DIR,
+        scheduler_port=scheduler_port,
+    ) as client:
+        if remote_workers:
+            local_workers = 0 if vertex_config.DASK_SCHEDULER_ADDRESS else vertex_config.DASK_N_WORKERS
+            print(f"waiting for the workers of {remote_workers} other replicas")
+            client.wait_for_workers(local_workers + remote_workers, timeout=vertex_config.DASK_WORKER_TIMEOUT)
+
+        # read and preprocess data, reusing the cached Parquet data of a previous run with the same inputs
+        preprocessed_train_df = load_preprocessed(
+            TRAINING_DATA_PATH, vertex_config.DATA_SCHEMA, vertex_config.DROP_COLUMNS, cache_dir)
+        preprocessed_test_df = load_preprocessed(
+            TEST_DATA_PATH, vertex_config.DATA_SCHEMA, vertex_config.DROP_COLUMNS, cache_dir)
+        print("df preprocessed")
+
+        # hold out part of the training data for early stopping, so that the test set
+        # reported in metrics.json (and gated on AVG_PR_THRESHOLD) stays unseen by training
+        early_stopping = bool(vertex_config.EARLY_STOPPING_ROUNDS)
+        if early_stopping:
+            preprocessed_train_df, preprocessed_valid_df = preprocessed_train_df.random_split(
+                [1 - vertex_config.VALIDATION_FRACTION, vertex_config.VALIDATION_FRACTION], random_state=8)
+
+        # downsampling
+        ds_preprocessed_train_df = stratified_sample(
+            preprocessed_train_df, vertex_config.TARGET_COLUMN, vertex_config.SAMPLING_RATIOS,
+            replace=vertex_config.SAMPLING_REPLACE)
     
-    # target, features split
-    x_train = ds_preprocessed_train_df[vertex_config.FEAT_COLUMNS].values
-    y_train = ds_preprocessed_train_df.loc[:, vertex_config.TARGET_COLUMN].astype(int).values
-    x_true = preprocessed_test_df[vertex_config.FEAT_COLUMNS].values
-    y_true = preprocessed_test_df.loc[:, vertex_config.TARGET_COLUMN].astype(int).values
+        # target, features split
+        x_train = ds_preprocessed_train_df[vertex_config.FEAT_COLUMNS].values
+        y_train = ds_preprocessed_train_df.loc[:, vertex_config.TARGET_COLUMN].astype(int).values
+        eval_set = None
+        if early_stopping:
+            eval_set = [(preprocessed_valid_df[vertex_config.FEAT_COLUMNS].values,
+                         preprocessed_valid_df.loc[:, vertex_config.TARGET_COLUMN].astype(int).values)]
     
-    # train model
-    print("start training")
-    cluster =  LocalCluster()
-    client = Client(cluster)
-    model = xgb.dask.DaskXGBClassifier(objective="reg:logistic", eval_metric="logloss")
-    model.client = client
-    model.fit(x_train, y_train, eval_set=[(x_true, y_true)])
-    print("finish training")
-    if not Path(MODEL_DIR).exists():
-        Path(MODEL_DIR).mkdir(parents=True, exist_ok=True)
-    model.save_model(MODEL_PATH)
-    print("model saved")
+        # resume from the last checkpoint of a preempted run of this job
+        checkpoint = None
+        if vertex_config.RESUME_FROM_CHECKPOINT:
+            checkpoint = latest_checkpoint(CHECKPOINT_DIR)
+        done_rounds = checkpoint.num_boosted_rounds() if checkpoint is not None else 0
+        n_estimators = vertex_config.N_ESTIMATORS - done_rounds
+        if checkpoint is not None:
+            print(f"resuming from checkpoint after {done_rounds} rounds")
+
+        callbacks = []
+        if early_stopping:
+            # keep only the trees up to the best round, so the saved model is the evaluated one
+            callbacks.append(xgb.callback.EarlyStopping(
+                rounds=vertex_config.EARLY_STOPPING_ROUNDS, metric_name="logloss", save_best=True))
+        if vertex_config.CHECKPOINT_INTERVAL > 0:
+            Path(CHECKPOINT_DIR).mkdir(parents=True, exist_ok=True)
+            callbacks.append(xgb.callback.TrainingCheckPoint(
+                directory=CHECKPOINT_DIR, name="checkpoint", interval=vertex_config.CHECKPOINT_INTERVAL))
+
+        # train model
+        print("start training")
+        model = xgb.dask.DaskXGBClassifier(
+            objective="reg:logistic", eval_metric="logloss", n_estimators=max(n_estimators, 1),
+            callbacks=callbacks)
+        model.client = client
+        if n_estimators > 0:
+            model.fit(x_train, y_train, eval_set=eval_set, xgb_model=checkpoint)
+        else:
+            # the checkpoint already holds every round
+            model.load_model(bytearray(checkpoint.save_raw()))
+        print("finish training")
+        if not Path(MODEL_DIR).exists():
+            Path(MODEL_DIR).mkdir(parents=True, exist_ok=True)
+        model.save_model(MODEL_PATH)
+        # the checkpoints are not part of the model artifact
+        shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
+        print("model saved")
     
-    #generate metrics
-    metrics = evaluate_model(model, x_true, y_true)
-    if not Path(deliverable_uri).exists():
-        Path(deliverable_uri).mkdir(parents=True, exist_ok=True)
-    with open(metrics_uri, "w") as file:
-        json.dump(metrics, file, sort_keys=True, indent=2)
-    print("metrics saved")
+        #generate metrics
+        metrics = evaluate_model(model, preprocessed_test_df, vertex_config.FEAT_COLUMNS, vertex_config.TARGET_COLUMN,
+                                 threshold=vertex_config.MODEL_THRESHOLD, bins=vertex_config.EVAL_CURVE_BINS)
+        if not Path(deliverable_uri).exists():
+            Path(deliverable_uri).mkdir(parents=True, exist_ok=True)
+        with open(metrics_uri, "w") as file:
+            json.dump(metrics, file, sort_keys=True, indent=2)
+        print("metrics saved")
+
+
+def worker_main():
+    # replicas other than the chief only run a dask worker attached to the chief's scheduler
+    scheduler_address = (vertex_config.DASK_SCHEDULER_ADDRESS or
+                         chief_scheduler_address(cluster_spec(), vertex_config.DASK_SCHEDULER_PORT))
+    run_dask_worker(
+        scheduler_address,
+        threads=vertex_config.DASK_THREADS_PER_WORKER,
+        memory_limit=vertex_config.DASK_MEMORY_LIMIT,
+        spill_dir=vertex_config.DASK_SPILL_DIR,
+        timeout=vertex_config.DASK_WORKER_TIMEOUT,
+    )
 
 
 if __name__ == "__main__":
-    print("start training...")
-    main()
-    print("finish training")
+    if is_chief(cluster_spec()):
+        print("start training...")
+        main()
+        print("finish training")
+    else:
+        print("start dask worker...")
+        worker_main()
+        print("dask worker stopped")
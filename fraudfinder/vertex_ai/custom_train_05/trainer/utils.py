@@ -1,15 +1,61 @@
-from typing import List, Union, Dict, Optional
+import os
+import glob
+import asyncio
+import json
+import hashlib
+import threading
+import contextlib
+from pathlib import Path
+from typing import Any, Iterator, List, Union, Dict, Optional
 import numpy as np
+import pandas as pd
+import dask
 import dask.dataframe as dask_df
+from dask.distributed import LocalCluster, Client
+from dask.utils import parse_bytes
+from dask.system import CPU_COUNT
+from distributed.system import MEMORY_LIMIT
 import xgboost as xgb
-from sklearn.metrics import (roc_curve, confusion_matrix, average_precision_score, f1_score, 
-                            log_loss, precision_score, recall_score)
 from google.cloud import storage
 from pydantic import BaseModel, Field
 
 
+# The image only ships trainer/, so the client registry of vertex_ai/utils.py is
+# reduced here to the storage client the trainer reads its config with
+CLIENT_POOL_SIZE = int(os.environ.get("CLIENT_POOL_SIZE", 32))
+
+_storage_clients: Dict[Optional[str], storage.Client] = {}
+_storage_clients_lock = threading.Lock()
+
+
+def get_storage_client(project: Optional[str] = None) -> storage.Client:
+    """storage client of `project`, created once and shared by all threads
+
+    Args:
+        project (Optional[str]): project of the client
+
+    Returns:
+        storage.Client: the shared client
+    """
+    client = _storage_clients.get(project)
+    if client is None:
+        with _storage_clients_lock:
+            client = _storage_clients.get(project)
+            if client is None:
+                import google.auth
+                import requests
+                from google.auth.transport.requests import AuthorizedSession
+
+                credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+                session = AuthorizedSession(credentials)
+                session.mount("https://", requests.adapters.HTTPAdapter(
+                    pool_connections=CLIENT_POOL_SIZE, pool_maxsize=CLIENT_POOL_SIZE))
+                client = _storage_clients[project] = storage.Client(project=project, _http=session)
+    return client
+
+
 def gcs_read(project_id: str, bucket: str, blob_name: str) -> storage.Blob:
-    client = storage.Client(project=project_id)
+    client = get_storage_client(project_id)
     bucket = client.bucket(bucket_name=bucket)
     return bucket.blob(blob_name)
 
@@ -66,6 +112,23 @@ class VertexConfig(BaseModel):
     PERSISTENT_RESOURCE_ID: Optional[str] = Field(default=None)
     REPLICA_COUNT: int = Field(default=1)
     SERVICE_ACCOUNT: str
+    EVAL_CURVE_BINS: int = Field(default=100)
+    DATA_CACHE_ENABLED: bool = Field(default=True)
+    DATA_CACHE_URI: Optional[str] = Field(default=None)
+    DASK_SCHEDULER_ADDRESS: Optional[str] = Field(default=None)
+    DASK_N_WORKERS: int = Field(default=1)
+    DASK_THREADS_PER_WORKER: Optional[int] = Field(default=None)
+    DASK_MEMORY_LIMIT: str = Field(default="auto")
+    DASK_SPILL_DIR: Optional[str] = Field(default=None)
+    DASK_SCHEDULER_PORT: int = Field(default=8786)
+    DASK_WORKER_TIMEOUT: float = Field(default=600)
+    SAMPLING_RATIOS: Dict[int, float] = Field(default={0: 1.0, 1: 1.0})
+    SAMPLING_REPLACE: bool = Field(default=True)
+    N_ESTIMATORS: int = Field(default=100)
+    EARLY_STOPPING_ROUNDS: Optional[int] = Field(default=10)
+    VALIDATION_FRACTION: float = Field(default=0.1)
+    CHECKPOINT_INTERVAL: int = Field(default=10)
+    RESUME_FROM_CHECKPOINT: bool = Field(default=True)
 
 
 def gcs_path_to_local_path(old_path: str) -> str:
@@ -84,11 +147,153 @@ def gcs_path_to_local_path(old_path: str) -> str:
     return new_path
 
 
+def cluster_spec() -> Dict[str, Any]:
+    """cluster layout of the training job, set by Vertex AI in CLUSTER_SPEC
+
+    Returns:
+        Dict[str, Any]: parsed spec, empty when running outside of a multi-replica job
+    """
+    return json.loads(os.environ.get("CLUSTER_SPEC", "{}"))
+
+
+def is_chief(spec: Dict[str, Any]) -> bool:
+    """whether this replica is the chief (first replica of workerpool0), the only one that trains and writes
+
+    Args:
+        spec (Dict[str, Any]): cluster spec
+
+    Returns:
+        bool: True on the chief, or when there is no cluster spec
+    """
+    task = spec.get("task", {})
+    return task.get("type", "workerpool0") == "workerpool0" and task.get("index", 0) == 0
+
+
+def chief_scheduler_address(spec: Dict[str, Any], port: int) -> str:
+    """address of the dask scheduler started by the chief replica
+
+    Args:
+        spec (Dict[str, Any]): cluster spec
+        port (int): port the scheduler listens on
+
+    Returns:
+        str: scheduler address
+    """
+    chief = spec["cluster"]["workerpool0"][0]
+    host = chief.rsplit(":", 1)[0]
+    return f"tcp://{host}:{port}"
+
+
+@contextlib.contextmanager
+def dask_client(scheduler_address: Optional[str] = None, n_workers: int = 1, threads_per_worker: Optional[int] = None,
+                memory_limit: str = "auto", spill_dir: Optional[str] = None,
+                scheduler_port: Optional[int] = None) -> Iterator[Client]:
+    """connect to a Dask cluster, closing it on exit
+
+    Connects to the scheduler at `scheduler_address` when given, otherwise starts a LocalCluster
+    sized to the machine: by default one worker using all cores, which is the layout XGBoost
+    trains fastest with. With `scheduler_port`, the local scheduler listens on every interface
+    so that the workers of the other replicas can join it (see run_dask_worker).
+
+    Args:
+        scheduler_address (Optional[str]): address of an existing scheduler
+        n_workers (int): number of local workers
+        threads_per_worker (Optional[int]): threads of each local worker, all cores split across workers by default
+        memory_limit (str): memory limit of each local worker, e.g. "12GB" or "auto"
+        spill_dir (Optional[str]): local directory the workers spill to
+        scheduler_port (Optional[int]): port of the local scheduler, reachable from other machines
+
+    Yields:
+        Client: client of the cluster
+    """
+    if scheduler_address:
+        client = Client(scheduler_address)
+        print(f"connected to dask scheduler {scheduler_address}")
+        try:
+            yield client
+        finally:
+            client.close()
+        return
+
+    threads_per_worker = threads_per_worker or max(1, CPU_COUNT // n_workers)
+    if n_workers * threads_per_worker > CPU_COUNT:
+        print(f"warning: {n_workers} workers x {threads_per_worker} threads oversubscribe {CPU_COUNT} cores")
+    if memory_limit != "auto" and n_workers * parse_bytes(memory_limit) > MEMORY_LIMIT:
+        print(f"warning: {n_workers} workers x {memory_limit} exceed the {MEMORY_LIMIT / 2**30:.1f} GiB of the machine")
+
+    network = {"host": "0.0.0.0", "scheduler_port": scheduler_port} if scheduler_port else {}
+    with LocalCluster(n_workers=n_workers, threads_per_worker=threads_per_worker,
+                      memory_limit=memory_limit, local_directory=spill_dir, **network) as cluster:
+        with Client(cluster) as client:
+            print(f"started dask cluster {cluster.scheduler_address}: {n_workers} workers x {threads_per_worker} threads, "
+                  f"memory limit {memory_limit}")
+            yield client
+
+
+def run_dask_worker(scheduler_address: str, threads: Optional[int] = None, memory_limit: str = "auto",
+                    spill_dir: Optional[str] = None, timeout: float = 600) -> None:
+    """run a dask worker attached to `scheduler_address` until the scheduler closes
+
+    Used by the replicas other than the chief, which lend their cores and memory to the chief's cluster.
+
+    Args:
+        scheduler_address (str): address of the scheduler
+        threads (Optional[int]): threads of the worker, all cores by default
+        memory_limit (str): memory limit of the worker, e.g. "12GB" or "auto"
+        spill_dir (Optional[str]): local directory the worker spills to
+        timeout (float): seconds to wait for the scheduler to come up
+    """
+    from distributed import Worker
+
+    async def run():
+        async with Worker(scheduler_address, nthreads=threads or CPU_COUNT, memory_limit=memory_limit,
+                          local_directory=spill_dir, death_timeout=timeout) as worker:
+            print(f"dask worker {worker.address} attached to {scheduler_address}")
+            await worker.finished()
+
+    asyncio.run(run())
+
+
 def resample(df: dask_df.DataFrame, replace: bool, frac: float = 1, random_state: int = 8) -> dask_df.DataFrame:
     shuffled_df = df.sample(frac=frac, replace=replace, random_state=random_state)
     return shuffled_df
 
 
+def stratified_sample(df: dask_df.DataFrame, target_col: str, ratios: Dict[int, float] = None,
+                      replace: bool = False, random_state: int = 8) -> dask_df.DataFrame:
+    """sample each class of `target_col` to a target ratio
+
+    The class counts are computed in a single aggregation; the sampling itself stays lazy.
+
+    Args:
+        df (dask_df.DataFrame): data to sample
+        target_col (str): class column
+        ratios (Dict[int, float]): rows of each class per row of the smallest class, 1 for the classes not listed
+        replace (bool): sample with replacement; without it a class cannot be upsampled
+        random_state (int): seed of the sampling
+
+    Returns:
+        dask_df.DataFrame: sampled data
+    """
+    counts = df[target_col].value_counts().compute().to_dict()
+    minority_count = min(counts.values())
+    ratios = ratios or {label: 1.0 for label in counts}
+
+    samples = []
+    for label, count in sorted(counts.items()):
+        # classes missing from `ratios` keep the ratio of a balanced sample
+        ratio = ratios.get(label, 1.0)
+        if ratio <= 0:
+            raise ValueError(f"sampling ratio of class {label} must be positive, got {ratio}")
+        frac = minority_count * ratio / count
+        if not replace and frac > 1:
+            print(f"warning: class {label} has {count} rows, keeping all of them since replace is off")
+            frac = 1.0
+        class_df = df[df[target_col] == label]
+        samples.append(class_df if frac == 1 else resample(class_df, replace, frac, random_state))
+    return dask_df.concat(samples)
+
+
 def preprocess(df: dask_df.DataFrame, drop_cols: List[str] = None) -> dask_df.DataFrame:
     if drop_cols:
         df = df.drop(columns=drop_cols)
@@ -104,39 +309,254 @@ def preprocess(df: dask_df.DataFrame, drop_cols: List[str] = None) -> dask_df.Da
     return df
 
 
-def evaluate_model(model: xgb.Booster, x_true: Union[dask_df.DataFrame, np.ndarray], y_true: Union[dask_df.Series, np.ndarray]) -> dict:
-    y_true = y_true.compute()
- 
+# bump when preprocess() changes, so that older cached data is not reused
+PREPROCESS_VERSION = 1
+
+
+def file_checksums(data_path: str) -> List[str]:
+    """content checksums of the files matched by `data_path`
+
+    Files under /gcs/ are identified by the crc32c (or md5) checksum GCS keeps in the object
+    metadata, so they do not have to be read; other local files are hashed. Names and
+    modification times are left out: a managed dataset is exported to a new path on every job.
+
+    Args:
+        data_path (str): local (/gcs/) path or wildcard of the files
+
+    Returns:
+        List[str]: sorted checksums of the files
+    """
+    if data_path.startswith("/gcs/"):
+        import gcsfs
+
+        fs = gcsfs.GCSFileSystem()
+        files = fs.glob(data_path[len("/gcs/"):])
+        infos = [fs.info(file) for file in files]
+        checksums = [f"{info.get('crc32c') or info['md5Hash']}:{info['size']}" for info in infos]
+    else:
+        files = glob.glob(data_path)
+        checksums = []
+        for file in files:
+            digest = hashlib.sha256()
+            with open(file, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            checksums.append(f"{digest.hexdigest()}:{os.path.getsize(file)}")
+    if not files:
+        raise FileNotFoundError(f"no input files match {data_path}")
+    return sorted(checksums)
+
+
+def data_fingerprint(data_path: str, schema: Dict[str, str], drop_cols: List[str] = None) -> str:
+    """fingerprint of the content of the input files and of the preprocessing config
+
+    Args:
+        data_path (str): local (/gcs/) path or wildcard of the input CSVs
+        schema (Dict[str, str]): dtypes the CSVs are read with
+        drop_cols (List[str]): columns dropped by preprocess
+
+    Returns:
+        str: hex digest identifying the preprocessed data
+    """
+    digest = hashlib.sha256()
+    for checksum in file_checksums(data_path):
+        digest.update(f"{checksum}\n".encode())
+    config = {"schema": schema, "drop_cols": drop_cols or [], "version": PREPROCESS_VERSION}
+    digest.update(json.dumps(config, sort_keys=True).encode())
+    return digest.hexdigest()[:32]
+
+
+def read_cached(cache_path: Path) -> dask_df.DataFrame:
+    """read the cached Parquet data, one partition per file
+
+    dask's read_parquet merges partitions depending on the columns selected afterwards,
+    so the features and the label of the same frame could come back split differently.
+    Reading whole files keeps a single partitioning for every column selection.
+
+    Args:
+        cache_path (Path): directory of the cached data
+
+    Returns:
+        dask_df.DataFrame: preprocessed data
+    """
+    files = sorted(cache_path.glob("*.parquet"), key=lambda path: (len(path.name), path.name))
+    return dask_df.from_map(pd.read_parquet, [str(file) for file in files])
+
+
+def load_preprocessed(data_path: str, schema: Dict[str, str], drop_cols: List[str] = None,
+                      cache_dir: Optional[str] = None) -> dask_df.DataFrame:
+    """read and preprocess the CSVs, going through a Parquet cache when `cache_dir` is set
+
+    The preprocessed data is stored under `cache_dir`/<fingerprint>, and a `_SUCCESS`
+    marker is written once it is complete, so an interrupted write is never read back.
+
+    Args:
+        data_path (str): local (/gcs/) path or wildcard of the input CSVs
+        schema (Dict[str, str]): dtypes the CSVs are read with
+        drop_cols (List[str]): columns dropped by preprocess
+        cache_dir (Optional[str]): local (/gcs/) directory of the cached data
+
+    Returns:
+        dask_df.DataFrame: preprocessed data
+    """
+    if not cache_dir:
+        return preprocess(dask_df.read_csv(data_path, dtype=schema), drop_cols)
+
+    cache_path = Path(cache_dir)/data_fingerprint(data_path, schema, drop_cols)
+    if (cache_path/"_SUCCESS").exists():
+        print(f"loading preprocessed data from {cache_path}")
+        return read_cached(cache_path)
+
+    df = preprocess(dask_df.read_csv(data_path, dtype=schema), drop_cols)
+    df.to_parquet(str(cache_path), write_index=False, overwrite=True)
+    (cache_path/"_SUCCESS").touch()
+    print(f"preprocessed data cached in {cache_path}")
+    return read_cached(cache_path)
+
+
+def latest_checkpoint(checkpoint_dir: str, name: str = "checkpoint") -> Optional[xgb.Booster]:
+    """load the most recent readable checkpoint written by xgb.callback.TrainingCheckPoint
+
+    A checkpoint that cannot be loaded, e.g. because the job was preempted while writing it,
+    is skipped in favour of the previous one.
+
+    Args:
+        checkpoint_dir (str): local (/gcs/) directory of the checkpoints
+        name (str): name prefix of the checkpoint files
+
+    Returns:
+        Optional[xgb.Booster]: latest booster, None when there is no checkpoint
+    """
+    checkpoints = []
+    for path in Path(checkpoint_dir).glob(f"{name}_*.*"):
+        iteration = path.stem[len(name) + 1:]
+        if iteration.isdigit():
+            checkpoints.append((int(iteration), path))
+
+    for _, path in sorted(checkpoints, reverse=True):
+        booster = xgb.Booster()
+        try:
+            booster.load_model(str(path))
+        except xgb.core.XGBoostError as e:
+            print(f"warning: skipping unreadable checkpoint {path}: {e}")
+            continue
+        return booster
+    return None
+
+
+def partition_metric_state(y_true: np.ndarray, y_score: np.ndarray, threshold: float, bins: int) -> np.ndarray:
+    """accumulate the evaluation state of one partition
+
+    Args:
+        y_true (np.ndarray): binary labels of the partition
+        y_score (np.ndarray): positive class scores of the partition
+        threshold (float): score above which a transaction is predicted as fraud
+        bins (int): number of fixed-width score bins over [0, 1]
+
+    Returns:
+        np.ndarray: negative and positive score histograms, confusion counts and log loss sum
+    """
+    y_true = np.asarray(y_true).astype(np.int64)
+    y_score = np.asarray(y_score, dtype=np.float64)
+    y_pred = (y_score > threshold).astype(np.int64)
+
+    # score histograms of the negatives (first half) and the positives (second half)
+    bin_idx = np.clip((y_score * bins).astype(np.int64), 0, bins - 1)
+    histograms = np.bincount(y_true * bins + bin_idx, minlength=2 * bins)
+
+    # confusion counts: index = 2 * true label + predicted label
+    confusion = np.bincount(2 * y_true + y_pred, minlength=4)
+
+    # log loss of the hard predictions, clipped as sklearn does
+    eps = np.finfo(np.float64).eps
+    p = np.clip(y_pred.astype(np.float64), eps, 1 - eps)
+    loss_sum = -np.sum(y_true * np.log(p) + (1 - y_true) * np.log(1 - p))
+
+    return np.concatenate([histograms, confusion, [loss_sum]]).astype(np.float64)
+
+
+def partition_scores_state(part: pd.DataFrame, booster: xgb.Booster, feature_columns: List[str], target_column: str,
+                           threshold: float, bins: int) -> np.ndarray:
+    """score one partition of the test set and accumulate its evaluation state
+
+    Labels and scores come from the same partition, so they always line up.
+
+    Args:
+        part (pd.DataFrame): partition with the feature and target columns
+        booster (xgb.Booster): trained booster
+        feature_columns (List[str]): feature columns, in training order
+        target_column (str): label column
+        threshold (float): score above which a transaction is predicted as fraud
+        bins (int): number of fixed-width score bins over [0, 1]
+
+    Returns:
+        np.ndarray: evaluation state of the partition, see partition_metric_state
+    """
+    y_true = part[target_column].astype(int).to_numpy()
+    y_score = booster.inplace_predict(part[feature_columns].to_numpy(dtype=np.float32))
+    assert len(y_true) == len(y_score), f"{len(y_true)} labels for {len(y_score)} scores"
+    return partition_metric_state(y_true, y_score, threshold, bins)
+
+
+def evaluate_model(model: Union[xgb.Booster, xgb.XGBModel], test_df: Union[dask_df.DataFrame, pd.DataFrame],
+                   feature_columns: List[str], target_column: str, threshold: float = 0.5, bins: int = 100) -> dict:
+    """compute the evaluation metrics of the model on the test set
+
+    Args:
+        model (Union[xgb.Booster, xgb.XGBModel]): trained model
+        test_df (Union[dask_df.DataFrame, pd.DataFrame]): test set with the feature and target columns
+        feature_columns (List[str]): feature columns, in training order
+        target_column (str): label column
+        threshold (float): score above which a transaction is predicted as fraud
+        bins (int): number of fixed-width score bins of the ROC and PR curves
+
+    Returns:
+        dict: metrics
+    """
+    booster = model.get_booster() if isinstance(model, xgb.XGBModel) else model
+    test_df = test_df[feature_columns + [target_column]]
+
+    # reduce fixed-size partition states so memory stays constant as the test set grows
+    if isinstance(test_df, pd.DataFrame):
+        states = [partition_scores_state(test_df, booster, feature_columns, target_column, threshold, bins)]
+    else:
+        accumulate = dask.delayed(partition_scores_state)
+        booster = dask.delayed(booster)
+        states = dask.compute(*[
+            accumulate(part, booster, feature_columns, target_column, threshold, bins)
+            for part in test_df.to_delayed()
+        ])
+    state = np.sum(states, axis=0)
+    neg_hist, pos_hist = state[:bins], state[bins:2 * bins]
+    tn, fp, fn, tp = state[2 * bins:2 * bins + 4].astype(int).tolist()
+    n = tn + fp + fn + tp
+
     #calculate metrics
     metrics={}
 
-    y_score =  model.predict_proba(x_true)[:, 1]
-    y_score = y_score.compute()
-    fpr, tpr, thr = roc_curve(
-         y_true=y_true, y_score=y_score, pos_label=True
-    )
-    fpr_list = fpr.tolist()[::1000]
-    tpr_list = tpr.tolist()[::1000]
-    thr_list = thr.tolist()[::1000]
-
-    y_pred = model.predict(x_true)
-    y_pred = y_pred.compute()
-    c_matrix = confusion_matrix(y_true, y_pred)
- 
-    avg_precision_score = round(average_precision_score(y_true, y_score), 3)
-    f1 = round(f1_score(y_true, y_pred), 3)
-    lg_loss = round(log_loss(y_true, y_pred), 3)
-    prec_score = round(precision_score(y_true, y_pred), 3)
-    rec_score = round(recall_score(y_true, y_pred), 3)
-
-    metrics["fpr"] = [round(f, 3) for f in fpr_list]
-    metrics["tpr"] = [round(f, 3) for f in tpr_list]
-    metrics["thrs"] = [round(f, 3) for f in thr_list]
-    metrics["confusion_matrix"] = c_matrix.tolist()
+    # fixed-bin ROC and PR curves: counts of scores at or above each bin edge, by decreasing threshold
+    tps = np.cumsum(pos_hist[::-1])
+    fps = np.cumsum(neg_hist[::-1])
+    thr = np.arange(bins - 1, -1, -1) / bins
+    fpr = np.r_[0, fps / fps[-1]] if fps[-1] else np.full(bins + 1, np.nan)
+    tpr = np.r_[0, tps / tps[-1]] if tps[-1] else np.full(bins + 1, np.nan)
+    precision = np.divide(tps, tps + fps, out=np.zeros(bins), where=(tps + fps) > 0)
+    recall = tps / tps[-1] if tps[-1] else np.zeros(bins)
+    avg_precision_score = round(float(np.sum(np.diff(recall, prepend=0) * precision)), 3)
+
+    prec_score = tp / (tp + fp) if tp + fp else 0.0
+    rec_score = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else 0.0
+    lg_loss = state[-1] / n if n else 0.0
+
+    metrics["fpr"] = [round(f, 3) for f in fpr.tolist()]
+    metrics["tpr"] = [round(f, 3) for f in tpr.tolist()]
+    metrics["thrs"] = [round(f, 3) for f in np.r_[np.inf, thr].tolist()]
+    metrics["confusion_matrix"] = [[tn, fp], [fn, tp]]
     metrics["avg_precision_score"] = avg_precision_score
-    metrics["f1_score"] = f1
-    metrics["log_loss"] = lg_loss
-    metrics["precision_score"] = prec_score
-    metrics["recall_score"] = rec_score
+    metrics["f1_score"] = round(f1, 3)
+    metrics["log_loss"] = round(float(lg_loss), 3)
+    metrics["precision_score"] = round(prec_score, 3)
+    metrics["recall_score"] = round(rec_score, 3)
  
     return metrics
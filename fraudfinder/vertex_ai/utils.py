@@ -1,10 +1,73 @@
-from typing import List, Dict, Optional
+import os
+import threading
+from typing import Any, Callable, List, Dict, Optional
 from google.cloud import storage
 from pydantic import BaseModel, Field
 
+# Size of the HTTP connection pool of each shared client
+CLIENT_POOL_SIZE = int(os.environ.get("CLIENT_POOL_SIZE", 32))
+
+_clients: Dict[tuple, Any] = {}
+_clients_lock = threading.Lock()
+_credentials = None
+
+
+def _http_session(pool_size: int):
+    """authorized HTTP session with a connection pool of `pool_size`, sharing one credentials lookup"""
+    global _credentials
+    import google.auth
+    import requests
+    from google.auth.transport.requests import AuthorizedSession
+
+    if _credentials is None:
+        _credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    session = AuthorizedSession(_credentials)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    return session
+
+
+def shared_client(kind: str, factory: Callable[[], Any], project: Optional[str] = None,
+                  location: Optional[str] = None) -> Any:
+    """lazily created client, shared by all threads for a given (kind, project, location)
+
+    Args:
+        kind (str): client kind, e.g. "storage"
+        factory (Callable[[], Any]): creates the client on first use
+        project (Optional[str]): project of the client
+        location (Optional[str]): location of the client
+
+    Returns:
+        Any: the shared client
+    """
+    key = (kind, project, location)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = factory()
+    return client
+
+
+def get_storage_client(project: Optional[str] = None) -> storage.Client:
+    return shared_client(
+        "storage", lambda: storage.Client(project=project, _http=_http_session(CLIENT_POOL_SIZE)), project)
+
+
+def get_bigquery_client(project: Optional[str] = None, location: Optional[str] = None):
+    from google.cloud import bigquery
+
+    return shared_client(
+        "bigquery",
+        lambda: bigquery.Client(project=project, location=location, _http=_http_session(CLIENT_POOL_SIZE)),
+        project,
+        location,
+    )
+
 
 def gcs_read(project_id: str, bucket: str, blob_name: str) -> storage.Blob:
-    client = storage.Client(project=project_id)
+    client = get_storage_client(project_id)
     bucket = client.bucket(bucket_name=bucket)
     return bucket.blob(blob_name)
 